@@ -0,0 +1,54 @@
+import hashlib
+import os
+
+from pyarrow import feather
+
+# Сюда складываем все посчитанные заранее артефакты
+CACHE_DIR = '.cache'
+
+
+def fingerprint(paths, version):
+    """Короткий хеш содержимого входных файлов и версии кода, который из них строит артефакт."""
+    digest = hashlib.sha256(str(version).encode())
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def file_stamp(paths):
+    """Дешевый отпечаток файлов по размеру и времени изменения - для проверки на каждом прогоне страницы,
+    где хешировать содержимое слишком долго. Отсутствующий файл тоже дает отпечаток."""
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((path, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stamps.append((path, None, None))
+    return hashlib.sha256(repr(stamps).encode()).hexdigest()[:16]
+
+
+def artifact_path(name, key, ext, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, f'{name}-{key}.{ext}')
+
+
+def atomic_write(path, write):
+    """Пишем во временный файл и переименовываем, чтобы соседний процесс не прочитал недописанный артефакт."""
+    tmp = f'{path}.{os.getpid()}.tmp'
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def write_table(df, path):
+    """Сохраняет таблицу в несжатый Arrow IPC (Feather v2) - такой файл можно отобразить в память."""
+    atomic_write(path, lambda tmp: feather.write_feather(df.reset_index(drop=True), tmp, compression='uncompressed'))
+
+
+def read_table(path):
+    """Читает таблицу через memory map: числовые колонки без пропусков остаются видом на страницы файла,
+    поэтому несколько процессов на одной машине делят одну и ту же память."""
+    return feather.read_table(path, memory_map=True).to_pandas(split_blocks=True)
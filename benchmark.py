@@ -0,0 +1,113 @@
+"""Замер каждого этапа подготовки на синтетических заказах разного объема.
+
+    python benchmark.py --sizes 10000 100000 1000000 10000000 --output bench.jsonl
+
+Результат - JSON lines, по строке на (объем, этап), с одинаковым run для всего прогона,
+так что прогоны на разных машинах и коммитах можно сравнивать между собой.
+"""
+import argparse
+import os
+import platform
+import subprocess
+import tempfile
+import uuid
+
+import geopandas
+
+import instrumentation
+from cube import DailyCube, OrderCube
+from enrichment import (MOSCOW_CENTER, add_sort_ids, add_time_features, distance_from_center, enrich_orders,
+                        load_district_hierarchy, translate_weekdays)
+from ingest import read_orders
+from pipeline import order_pyramid, slice_hexbins
+from settings import DISTRICT_SOURCES, HEX_RADIUS
+from store import OrderStore
+from synthetic import generate_orders, write_archive
+from useragent import add_user_agent_features
+
+def benchmark_districts():
+    """Настоящая иерархия районов, а если архива с районами нет - округа в роли районов.
+    Число полигонов тогда меньше, но этап соединения меряется тем же кодом."""
+    if os.path.exists(DISTRICT_SOURCES[0].replace('zip://', '')):
+        return load_district_hierarchy(*DISTRICT_SOURCES)
+    moscow = geopandas.read_file('moscow.geojson').geometry.iloc[0]
+    okruga = geopandas.read_file('okruga.geojson')
+    okruga = okruga[okruga.within(moscow.buffer(0.01))]
+    return geopandas.GeoDataFrame({'okrug': okruga['local_name'], 'district': okruga['local_name']},
+                                  geometry=okruga.geometry.to_numpy(), crs=okruga.crs).reset_index(drop=True)
+
+
+def run_size(n, districts, workdir, seed):
+    path = os.path.join(workdir, f'orders-{n}.csv.zip')
+    write_archive(generate_orders(n, seed=seed), path)
+    with instrumentation.stage('ingest', rows_in=n) as record:
+        df = read_orders(path)
+        record['rows_out'] = len(df)
+    os.remove(path)
+    with instrumentation.stage('datetime_features', rows_in=len(df)) as record:
+        df = add_time_features(df)
+        record['rows_out'] = len(df)
+    with instrumentation.stage('distance', rows_in=len(df)) as record:
+        distance_from_center(df['location_latitude'], df['location_longitude'])
+        record['rows_out'] = len(df)
+    with instrumentation.stage('distance_spherical', rows_in=len(df)) as record:
+        distance_from_center(df['location_latitude'], df['location_longitude'], method='spherical')
+        record['rows_out'] = len(df)
+    with instrumentation.stage('district_join', rows_in=len(df)) as record:
+        df = enrich_orders(df, districts).dropna(subset=['district'])
+        record['rows_out'] = len(df)
+    with instrumentation.stage('user_agents', rows_in=len(df)) as record:
+        df = add_user_agent_features(add_sort_ids(translate_weekdays(df)))
+        record['rows_out'] = len(df)
+    with instrumentation.stage('store', rows_in=len(df)) as record:
+        store = OrderStore(df)
+        record['rows_out'] = len(store.orders)
+    with instrumentation.stage('aggregation', rows_in=len(df)) as record:
+        record['rows_out'] = len(OrderCube.from_orders(store.orders).cells)
+    with instrumentation.stage('daily_aggregation', rows_in=len(df)) as record:
+        record['rows_out'] = sum(len(cube.cells) for cube in DailyCube.from_orders(store.orders).views)
+    # Те же сборщики, что у пайплайна и страницы: подробные ячейки за весь период и грубые по дням
+    for daily, prefix in ((False, ''), (True, 'daily_')):
+        with instrumentation.stage(prefix + 'hexbin_payload', rows_in=len(df)) as record:
+            hexbins = slice_hexbins(store, HEX_RADIUS, daily=daily)
+            record['rows_out'] = sum(len(cells) for cells in hexbins.values())
+        with instrumentation.stage(prefix + 'cluster_payload', rows_in=len(df)) as record:
+            pyramid = order_pyramid(store.orders, daily=daily)
+            record['rows_out'] = len(pyramid.clusters(10, center=MOSCOW_CENTER))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000, 10_000_000])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-', help='куда писать JSON lines, "-" - в stdout')
+    parser.add_argument('--memory', action='store_true',
+                        help='мерить пиковую память через tracemalloc (время при этом завышается)')
+    args = parser.parse_args()
+
+    instrumentation.enable(memory=args.memory)
+    run = {'run': uuid.uuid4().hex, 'commit': git_commit(), 'python': platform.python_version(),
+           'machine': platform.machine(), 'cpus': os.cpu_count(), 'memory': args.memory}
+    districts = benchmark_districts()
+    out = open(args.output, 'a', encoding='utf-8') if args.output != '-' else None
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for n in args.sizes:
+                instrumentation.reset()
+                run_size(n, districts, workdir, args.seed)
+                print(instrumentation.to_json_lines(size=n, **run), end='', file=out, flush=True)
+    finally:
+        if out is not None:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+
+def fit_polynomials(x, y, weights, orders, grid):
+    """Взвешенный МНК-полином каждой степени из orders, посчитанный на точках grid.
+
+    Веса - количество заказов в корзине, так что фит по корзинам совпадает с фитом по всем заказам,
+    у которых x округлен до центра корзины.
+    """
+    curves = {}
+    for order in orders:
+        usable = weights > 0
+        if usable.sum() <= order:
+            curves[order] = np.full(len(grid), np.nan)
+            continue
+        poly = np.polynomial.Polynomial.fit(x[usable], y[usable], order, w=np.sqrt(weights[usable]))
+        curves[order] = poly(grid)
+    return curves
+
+
+def binned_regression(bins, x, y, weight, orders=(1, 3, 5), spread=None, n_boot=0, seed=0, level=0.95,
+                      grid_size=200):
+    """Полиномиальные регрессии по заранее собранным корзинам.
+
+    bins - таблица корзин: x - центр корзины, weight - число заказов в ней, y - фитируемая величина.
+    Если y - среднее по корзине (например, средний чек), фит взвешен числом заказов, а spread указывает
+    колонку со стандартным отклонением внутри корзины. Если y совпадает с weight, фитируется само
+    количество заказов, каждая корзина - одна точка.
+    При n_boot > 0 считает бутстреп-полосу уровня level: количество заказов по корзинам перевыбирается
+    мультиномиально, а средние в корзинах шумят со своим стандартным отклонением.
+    Возвращает таблицу кривых: x, y, degree и, если был бутстреп, lower и upper.
+    """
+    bins = bins.dropna(subset=[x, y])
+    counts_only = y == weight
+    xs = bins[x].to_numpy(dtype='float64')
+    ys = bins[y].to_numpy(dtype='float64')
+    ws = bins[weight].to_numpy(dtype='float64')
+    ones = np.ones_like(ws)
+    grid = np.linspace(xs.min(), xs.max(), grid_size) if len(xs) else np.empty(0)
+    curves = fit_polynomials(xs, ys, ones if counts_only else ws, orders, grid)
+    if n_boot:
+        rng = np.random.default_rng(seed)
+        total = int(ws.sum())
+        sd = bins[spread].fillna(0).to_numpy(dtype='float64') if spread else np.zeros_like(ws)
+        draws = {order: [] for order in orders}
+        # Без заказов (например, за пустой период) перевыбирать нечего - полоса остается пустой
+        for _ in range(n_boot if total else 0):
+            boot_w = rng.multinomial(total, ws / total).astype('float64')
+            if counts_only:
+                boot = fit_polynomials(xs, boot_w, ones, orders, grid)
+            else:
+                boot_y = ys + rng.standard_normal(len(ys)) * sd / np.sqrt(np.maximum(boot_w, 1))
+                boot = fit_polynomials(xs, boot_y, boot_w, orders, grid)
+            for order, curve in boot.items():
+                draws[order].append(curve)
+        tail = (1 - level) / 2 * 100
+    frames = []
+    for order in orders:
+        frame = pd.DataFrame({x: grid, y: curves[order], 'degree': str(order)})
+        if n_boot and draws[order]:
+            lower, upper = np.nanpercentile(np.vstack(draws[order]), [tail, 100 - tail], axis=0)
+            frame = frame.assign(lower=lower, upper=upper)
+        elif n_boot:
+            frame = frame.assign(lower=np.nan, upper=np.nan)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def distance_bins(totals, max_distance=30):
+    """Корзины расстояния из сумм куба: количество заказов, средний чек и его разброс в корзине."""
+    totals = totals[totals['distance_bucket'] < max_distance]
+    n = totals['amount_count'].replace(0, np.nan)
+    mean = totals['amount_sum'] / n
+    var = (totals['amount_sq_sum'] / n - mean ** 2).clip(lower=0)
+    return pd.DataFrame({'distance_from_center': totals['distance_bucket'],
+                         'id': totals['id'],
+                         'amount_charged': mean,
+                         'amount_sd': np.sqrt(var)}).reset_index(drop=True)
+
+
+def pivot_dense(totals, frame_dim, x_dim, value, frame_order, x_order):
+    """Плотный массив frames x x-значений из агрегата; пустые сочетания становятся NaN."""
+    table = totals.pivot_table(index=frame_dim, columns=x_dim, values=value, aggfunc='sum', observed=True)
+    return table.reindex(index=frame_order, columns=x_order).to_numpy(dtype='float64')
+
+
+def _bars(x, counts, means):
+    return [go.Bar(name='Количество заказов', x=x, y=counts, yaxis='y', offsetgroup=1),
+            go.Bar(name='Cредний чек', x=x, y=means, yaxis="y2", offsetgroup=2)]
+
+
+def animated_bars(totals, frame_dim, x_dim, frame_order, x_order, title, frame_title, x_title):
+    """Анимированный график "количество заказов и средний чек" по паре измерений.
+
+    totals - свертка куба по [frame_dim, x_dim] с колонками id и amount_charged. Агрегат один раз
+    разворачивается в плотные массивы, и все кадры со слайдером строятся прямо из их строк.
+    """
+    frame_order = [str(f) for f in frame_order]
+    x_order = [str(x) for x in x_order]
+    totals = totals.astype({frame_dim: str, x_dim: str})
+    counts = pivot_dense(totals, frame_dim, x_dim, 'id', frame_order, x_order)
+    means = pivot_dense(totals, frame_dim, x_dim, 'amount_charged', frame_order, x_order)
+    frames = [go.Frame(data=_bars(x_order, counts[i], means[i]), name=name) for i, name in enumerate(frame_order)]
+    steps = [dict(label=name, method="animate", args=[[name]]) for name in frame_order]
+    fig = go.Figure(data=_bars(x_order, counts[0], means[0]) if frame_order else [], frames=frames)
+    fig.update_layout(title=title,
+                      barmode='group',
+                      xaxis_title=x_title,
+                      yaxis=dict(title="Количество заказов", range=[0, np.nanmax(counts, initial=0) * 1.05]),
+                      yaxis2=dict(title="Средний чек", overlaying="y", side="right",
+                                  range=[0, np.nanmax(means, initial=0) * 1.05]),
+                      ##FROM (https://habr.com/ru/post/502958/)
+                      updatemenus=[dict(direction="left",
+                                        pad={"r": 10, "t": 80},
+                                        x=0.1,
+                                        xanchor="right",
+                                        y=0,
+                                        yanchor="top",
+                                        showactive=False,
+                                        type="buttons",
+                                        buttons=[dict(label="►", method="animate", args=[None, {"fromcurrent": True}]),
+                                                 dict(label="❚❚", method="animate",
+                                                      args=[[None], {"frame": {"duration": 0, "redraw": False},
+                                                                     "mode": "immediate",
+                                                                     "transition": {"duration": 0}}])])],
+                      ##END
+                      sliders=[dict(currentvalue={"prefix": frame_title + ": ", "font": {"size": 16}},
+                                    len=0.9,
+                                    x=0.1,
+                                    pad={"b": 10, "t": 50},
+                                    steps=steps)],
+                      legend_x=1.12, width=1200)
+    return fig
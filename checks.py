@@ -0,0 +1,96 @@
+"""Проверки того, что быстрые пути подготовки дают тот же результат, что и простые, на синтетических заказах.
+
+    python checks.py --size 60000
+
+Каждая проверка печатает OK или описание расхождения; если что-то разошлось, код выхода 1.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from benchmark import benchmark_districts
+from enrichment import PARALLEL_MIN_ROWS, add_time_features, enrich_orders
+from ingest import iter_budgeted_chunks, read_orders
+from pipeline import Aggregates, enrich_chunk, hexbin_table
+from store import OrderStore
+from synthetic import generate_orders, write_archive
+
+
+def check_parallel_enrichment(archive, districts, workers=3):
+    """enrich_orders с workers > 1 совпадает с последовательным до последнего значения."""
+    orders = add_time_features(read_orders(archive))
+    if len(orders) < PARALLEL_MIN_ROWS:
+        return f'заказов меньше PARALLEL_MIN_ROWS ({PARALLEL_MIN_ROWS}), параллельный путь не проверен'
+    serial = enrich_orders(orders, districts, workers=1)
+    parallel = enrich_orders(orders, districts, workers=workers)
+    try:
+        pd.testing.assert_frame_equal(parallel, serial, check_exact=True)
+    except AssertionError as error:
+        return str(error)
+    return None
+
+
+def check_chunked_aggregates(archive, districts, memory_budget=2 ** 22, hex_radius=120):
+    """Агрегаты, накопленные по кускам (как в build_full_artifacts), совпадают с посчитанными за один раз."""
+    chunked, chunks = Aggregates(hex_radius), 0
+    for chunk in iter_budgeted_chunks(archive, memory_budget, first_chunk=5_000):
+        chunked.add(OrderStore(enrich_chunk(chunk, districts)))
+        chunks += 1
+    if chunks < 2:
+        return 'архив прочитан одним куском, накопление не проверено'
+    whole = Aggregates(hex_radius).add(OrderStore(enrich_chunk(read_orders(archive), districts)))
+    tables = {'cube': lambda a: a.cube.to_frame(),
+              'daily_cube': lambda a: a.daily_cube.to_frame(),
+              'hexbins': lambda a: hexbin_table(a.hexbins),
+              'daily_hexbins': lambda a: hexbin_table(a.daily_hexbins),
+              'clusters': lambda a: a.pyramid.to_frame(),
+              'daily_clusters': lambda a: a.daily_pyramid.to_frame()}
+    problems = [f'{name}: {problem}' for name, table in tables.items()
+                for problem in [_compare_tables(table(chunked), table(whole))] if problem]
+    return '; '.join(problems) or None
+
+
+def _compare_tables(left, right):
+    """Таблицы агрегатов равны с точностью до порядка строк и порядка сложения дробных сумм."""
+    if sorted(left.columns) != sorted(right.columns):
+        return f'разные колонки {sorted(left.columns)} и {sorted(right.columns)}'
+    if len(left) != len(right):
+        return f'{len(left)} строк против {len(right)}'
+    floats = [c for c in left.columns if pd.api.types.is_float_dtype(left[c])]
+    keys = [c for c in left.columns if c not in floats]
+    left, right = (t.assign(**{c: t[c].astype(str) for c in keys}).sort_values(keys, ignore_index=True)
+                   for t in (left, right))
+    if not left[keys].equals(right[keys]):
+        return 'ключи или счетчики различаются'
+    mismatched = [c for c in floats if not np.allclose(left[c], right[c], equal_nan=True)]
+    return f'суммы различаются: {mismatched}' if mismatched else None
+
+
+CHECKS = [('parallel_enrichment', check_parallel_enrichment),
+          ('chunked_aggregates', check_chunked_aggregates)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=60_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    districts = benchmark_districts()
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = os.path.join(tmp, 'orders.csv.zip')
+        write_archive(generate_orders(args.size, seed=args.seed), archive)
+        for name, check in CHECKS:
+            problem = check(archive, districts)
+            print(f'{name}: {problem or "OK"}', flush=True)
+            failed = failed or problem is not None
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
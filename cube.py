@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+
+from timeindex import DAY_COLUMN, PrefixSums
+
+# Измерения куба. Любой групповой вид страницы - это свертка по части этих измерений
+CUBE_DIMS = ['okrug', 'district', 'day_of_week', 'Times_of_Day', 'os', 'distance_bucket']
+MEASURES = ['id', 'amount_count', 'amount_sum', 'amount_sq_sum']
+# Разрезы по дням заказов для фильтра по периоду - только измерения, по которым страница строит графики.
+# В каждом ячеек порядка (значения измерений) x (дни), а не произведение всех измерений на дни.
+# Новому графику по другим измерениям нужен свой разрез здесь
+DAILY_VIEWS = (('okrug', 'district'), ('okrug', 'day_of_week', 'Times_of_Day'), ('distance_bucket',), ('os',))
+
+
+def distance_bucket(distance_km):
+    """Корзина расстояния до центра с шагом 100 м - с такой точностью строятся графики по расстоянию."""
+    return np.round(np.asarray(distance_km, dtype='float64'), 1)
+
+
+class OrderCube:
+    """Предагрегированные заказы: количество, сумма и сумма квадратов amount_charged в каждой ячейке CUBE_DIMS.
+
+    Средние считаются только из сумм и количеств, поэтому свертка на любой уровень
+    дает то же самое, что groupby по сырым строкам, а новые заказы просто добавляются к ячейкам.
+    """
+
+    def __init__(self, cells):
+        self.cells = cells
+
+    @classmethod
+    def from_orders(cls, orders, dims=CUBE_DIMS):
+        amount = orders['amount_charged']
+        frame = pd.DataFrame({'okrug': orders['okrug'],
+                              'district': orders['district'],
+                              'day_of_week': orders['day_of_week'],
+                              'Times_of_Day': orders['Times_of_Day'],
+                              'os': orders['os'],
+                              'distance_bucket': distance_bucket(orders['distance_from_center']),
+                              DAY_COLUMN: orders[DAY_COLUMN],
+                              'id': orders['id'].notna().astype('int64'),
+                              'amount_count': amount.notna().astype('int64'),
+                              'amount_sum': amount.fillna(0),
+                              'amount_sq_sum': amount.fillna(0) ** 2})
+        return cls(frame.groupby(list(dims), dropna=False, observed=True)[MEASURES].sum())
+
+    def to_frame(self):
+        return self.cells.reset_index()
+
+    @classmethod
+    def from_frame(cls, frame, dims=CUBE_DIMS):
+        return cls(frame.set_index(list(dims)))
+
+    def append(self, orders):
+        """Досчитывает куб по новым заказам: агрегируются только они, старые ячейки просто складываются."""
+        new = OrderCube.from_orders(orders, self.cells.index.names).cells
+        self.cells = self.cells.add(new, fill_value=0).astype({'id': 'int64', 'amount_count': 'int64'})
+        return self
+
+    def count(self):
+        """Всего заказов в кубе."""
+        return int(self.cells['id'].sum())
+
+    def totals(self, dims, where=None):
+        """Сырые суммы MEASURES по измерениям dims.
+
+        where - необязательный фильтр ячеек, например {'distance_bucket': lambda d: d < 30}.
+        """
+        cells = self.cells.reset_index()
+        for dim, condition in (where or {}).items():
+            cells = cells[condition(cells[dim])]
+        return cells.groupby(list(dims), as_index=False, observed=True)[MEASURES].sum()
+
+    def rollup(self, dims, where=None):
+        """Свертка куба до измерений dims в том же виде, что давал
+        groupby(dims).agg({'id': 'count', 'amount_charged': 'mean'}).
+        """
+        totals = self.totals(dims, where)
+        totals['amount_charged'] = totals['amount_sum'] / totals['amount_count'].replace(0, np.nan)
+        return totals[list(dims) + ['id', 'amount_charged']]
+
+
+class DailyCube:
+    """Кубы по разрезам DAILY_VIEWS с днем заказа среди измерений - из них собирается куб за любой период.
+
+    between берет суммы за интервал дней из префиксных сумм, не пересчитывая ячейки, так что totals и rollup
+    на результате по измерениям любого разреза дают то же, что OrderCube по отфильтрованным заказам.
+    """
+
+    def __init__(self, views):
+        self.views = views
+        self._prefix = None
+
+    @classmethod
+    def from_orders(cls, orders):
+        return cls([OrderCube.from_orders(orders, list(view) + [DAY_COLUMN]) for view in DAILY_VIEWS])
+
+    def append(self, orders):
+        for cube in self.views:
+            cube.append(orders)
+        self._prefix = None
+        return self
+
+    def to_frame(self):
+        """Все разрезы одной таблицей: в колонке view - номер разреза в DAILY_VIEWS."""
+        return pd.concat([cube.to_frame().assign(view=number) for number, cube in enumerate(self.views)],
+                         ignore_index=True)
+
+    @classmethod
+    def from_frame(cls, frame):
+        views = []
+        for number, view in enumerate(DAILY_VIEWS):
+            dims = list(view) + [DAY_COLUMN]
+            views.append(OrderCube.from_frame(frame.loc[frame['view'] == number, dims + MEASURES], dims))
+        return cls(views)
+
+    def _prefix_sums(self):
+        if self._prefix is None:
+            self._prefix = [PrefixSums(cube.to_frame(), view, MEASURES) for cube, view in zip(self.views, DAILY_VIEWS)]
+        return self._prefix
+
+    @property
+    def days(self):
+        """Первый и последний день заказов."""
+        prefix = self._prefix_sums()[0]
+        return prefix.first_day, prefix.last_day
+
+    def between(self, start, end):
+        """Куб только по заказам с днем в [start, end] (номера дней, см. timeindex)."""
+        return CubeViews([OrderCube(prefix.between(start, end).set_index(prefix.keys))
+                          for prefix in self._prefix_sums()])
+
+
+class CubeViews:
+    """Несколько кубов по разным наборам измерений: свертка берется из первого, где есть все нужные."""
+
+    def __init__(self, cubes):
+        self.cubes = cubes
+
+    def _cube(self, dims, where):
+        needed = set(dims) | set(where or {})
+        for cube in self.cubes:
+            if needed <= set(cube.cells.index.names):
+                return cube
+        raise KeyError(f'Ни в одном разрезе нет измерений {sorted(needed)}')
+
+    def count(self):
+        return self.cubes[0].count()
+
+    def totals(self, dims, where=None):
+        return self._cube(dims, where).totals(dims, where)
+
+    def rollup(self, dims, where=None):
+        return self._cube(dims, where).rollup(dims, where)
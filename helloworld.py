@@ -1,20 +1,54 @@
 
+import uuid
+from concurrent.futures import FIRST_COMPLETED, wait
+
 import altair as alt
 import folium as folium
 import geopandas
 import numpy as np
-import pandas as pd
-import plotly.graph_objects as go
 import pydeck as pdk
 import streamlit as st
-from folium.plugins import FastMarkerCluster
-from geopy import distance
-from shapely.geometry import Point
 from streamlit_echarts import st_echarts
 from streamlit_folium import folium_static
 
+from artifacts import file_stamp
+from charts import animated_bars, binned_regression, distance_bins
+from cube import DailyCube, OrderCube
+from enrichment import TIMES_OF_DAY, WEEKDAYS, add_time_features, load_district_hierarchy
+from ingest import ORDER_DTYPES, iter_order_chunks
+import instrumentation
+from instrumentation import cached, stage
+from maps import geojson_layers, hex_centers
+from pipeline import (DAILY_HEX_SCALE, Artifacts, hexbin_table, latest_version, load_orders, order_pyramid,
+                      slice_hexbins)
+from settings import (ARTIFACTS_DIR, CHUNKSIZE, DATA_URL, DISTANCE_METHOD, DISTRICT_SOURCES, ENRICH_WORKERS, HEX_RADIUS,
+                      PREVIEW_ROWS, PROFILE_LOG, PROFILE_STAGES, SAMPLE_FRAC, SAMPLE_SEED)
+from stages import StageGraph
+from store import OrderStore
+from timeindex import PrefixSums, from_day, to_day
+from useragent import add_user_agent_features
+
+# Степень упрощения границ на картограмме: 'full', 'medium' или 'coarse'
+BOUNDARY_DETAIL = 'medium'
+# Сколько бутстреп-выборок для доверительной полосы регрессий по расстоянию, 0 - без полосы
+DISTANCE_FIT_BOOTSTRAP = 100
+# Пары измерений, которые можно анимировать: (кадры, ось x, подпись кадра, подпись оси x)
+ANIMATED_VIEWS = {'По дням недели и времени дня': ('day_of_week', 'Times_of_Day', 'День недели', 'Время дня'),
+                  'По округам и дням недели': ('okrug', 'day_of_week', 'Округ', 'День недели')}
+# Сколько секунд раздел ждет свои фоновые этапы, прежде чем показать заглушку: быстрые загрузки
+# (например, из готовых артефактов) так не мигают заглушкой
+READY_WAIT = 0.5
+# Раз в сколько секунд конец прогона обновляет прогресс фоновой подготовки. Между проверками streamlit
+# успевает прервать прогон, если посетитель тронул виджет
+PROGRESS_POLL = 0.25
+
 st.set_page_config(layout="wide")
-with st.echo(code_location='below'):
+if PROFILE_STAGES:
+    instrumentation.enable()
+instrumentation.reset()
+# Сюда в конце прогона выводится прогресс фоновой подготовки
+progress_slot = st.empty()
+with st.echo(code_location='below'), stage('ingest'):
     """
     # Анализ данных слива Яндекс.Еды 
     Один нехороший аналитик сервиса Яндекс.Еда слил данные заказов пользователей в открытый доступ
@@ -24,138 +58,181 @@ with st.echo(code_location='below'):
     """
 
 
-    @st.experimental_singleton()
-    def get_data():
-        data_url = 'yangodatanorm 3.csv.zip'
-        return pd.read_csv(data_url).sample(frac=0.01)
-
-
-    initial_df = get_data()
-    initial_df.drop('Unnamed: 0', axis=1)
-    st.write(initial_df)
-    df = initial_df.copy(deep=True)
-    st.write(len(df))
-with st.echo(code_location='below'):
-    """
-        После этого добавим некоторую дополнительную информацию для наших заказов
-        День недели, время дня, административный округ, расстояние до центра Москвы 
-    """
-    # Берем дни недели и часы
-    df['created_at'] = pd.to_datetime(df['created_at'], utc=True)
-    df['day_of_week'] = df['created_at'].dt.day_name()
-    df['Time'] = df['created_at'].dt.hour
-    df['Times_of_Day'] = 'null'
-    df['Times_of_Day'].mask((df['Time'] >= 6) & (df['Time'] <= 12), 'утро', inplace=True)
-    df['Times_of_Day'].mask((df['Time'] > 12) & (df['Time'] <= 18), 'день', inplace=True)
-    df['Times_of_Day'].mask((df['Time'] > 18) & (df['Time'] <= 23), 'вечер', inplace=True)
-    df['Times_of_Day'].mask(df['Times_of_Day'] == 'null', 'ночь', inplace=True)
-    df['Times_of_Day'] = df['Times_of_Day'].astype(str)
-
-
-    # @st.experimental_singleton()
-    # def get_distance():
-    #     # Добавляем расстояние до центра Москвы
-    #     distance_from_c = []
-    #     for lat, lon in zip(df['location_latitude'], df['location_longitude']):
-    #         distance_from_c.append(distance.distance((lat, lon), (55.753544, 37.621211)).km)
-    #         # geometry.append(Point(lon, lat))
-    #     return pd.Series(distance_from_c)
-    #
-    #
-    # dist = get_distance()
-    # df['distance_from_center'] = dist
-
-    @st.experimental_singleton()
-    def get_districts():
-        # Здесь мы получаем данные о полигонах московских административных округов и районов
-        # source (http://osm-boundaries.com)
+    @cached(st.experimental_singleton())
+    def get_graph():
+        # Все вычисления страницы - этапы одного графа. Каждый этап сам перечисляет свои входы и виджеты,
+        # от которых зависит, и кешируется по их отпечатку. Граф один на процесс и общий для всех сессий
+        return StageGraph()
 
-        districts_df = geopandas.read_file('zip://districts.geojson.zip')
-        moscow = geopandas.read_file('moscow.geojson')
-        okruga = geopandas.read_file('okruga.geojson')
-        moscow_geometry = list(moscow['geometry'])[0]
-        moscow_districts = pd.DataFrame()
-        idx = 0
-        for name, poly in zip(districts_df['local_name'], districts_df['geometry']):
-            if moscow_geometry.contains(poly):
-                for okr, geo in zip(okruga['local_name'], okruga['geometry']):
-                    if geo.contains(poly):
-                        moscow_districts.at[idx, 'okrug'] = okr
-                        moscow_districts.at[idx, 'district'] = name
-                        moscow_districts.at[idx, 'geometry'] = poly
-            else:
-                continue
-            idx += 1
-        return moscow_districts
 
+    graph = get_graph()
+    # Фоновые этапы, которые запросил этот прогон страницы, по именам
+    jobs = {}
 
-    moscow_geometry_df = get_districts()
 
+    def ready(*names):
+        # Тяжелые этапы считаются в фоне, и все сессии ждут один и тот же расчет. Пока он идет,
+        # раздел показывает заглушку, а страница рисуется дальше; готовые разделы появляются при перезапуске
+        futures = [graph.submit(name) for name in names]
+        jobs.update(zip(names, futures))
+        wait(futures, timeout=READY_WAIT)
+        # Упавший этап граф помнит и заново не считает, а раздел показывает ошибку вместо заглушки
+        failed = [future.exception() for future in futures if future.done() and future.exception() is not None]
+        for error in failed:
+            st.exception(error)
+        waiting = [name for name, future in zip(names, futures) if not future.done()]
+        if waiting:
+            st.info('Раздел появится, когда будут готовы данные: ' + ', '.join(waiting))
+        return not waiting and not failed
 
-    def get_coords(lat, lon):
-        return Point(lon, lat)
 
+    @graph.stage(fingerprint=lambda: latest_version(ARTIFACTS_DIR))
+    def latest_artifacts():
+        # Если офлайн-пайплайн (python pipeline.py) уже собрал артефакты, страница только читает их.
+        # Иначе все считается здесь же, при первом заходе. Новая сборка меняет отпечаток и пересчитывает граф
+        return Artifacts.latest(ARTIFACTS_DIR)
 
-    df['coords'] = df[['location_latitude', 'location_longitude']].apply(lambda x: get_coords(*x), axis=1)
 
-
-    @st.experimental_memo
-    def get_municipality():
-        new_df = df.copy(deep=True)
-        for idx, row in new_df.iterrows():
-            coord = row.coords
-            lat = row.location_latitude
-            lon = row.location_longitude
-            new_df.at[idx, 'distance_from_center'] = distance.distance((lat, lon), (55.753544, 37.621211)).km
-            for distr, okr, geometry in zip(moscow_geometry_df['district'], moscow_geometry_df['okrug'],
-                                            moscow_geometry_df['geometry']):
-                if geometry.contains(coord):
-                    new_df.at[idx, 'district'] = distr
-                    new_df.at[idx, 'okrug'] = okr
-                    break
-                else:
-                    continue
-        return new_df
-
-
-    full_df = get_municipality()
+    @graph.stage(inputs=['latest_artifacts'],
+                 fingerprint=lambda: file_stamp([path.replace('zip://', '') for path in DISTRICT_SOURCES]))
+    def district_table(artifacts):
+        # Здесь мы получаем данные о полигонах московских административных округов и районов
+        # source (http://osm-boundaries.com)
+        if artifacts:
+            return artifacts.districts()
+        # Сама геометрия считается один раз и сохраняется в .cache, дальше только читаем готовый файл
+        return load_district_hierarchy(*DISTRICT_SOURCES)
+
+
+    @graph.stage(inputs=['latest_artifacts', 'district_table'],
+                 fingerprint=lambda: (file_stamp([DATA_URL]), SAMPLE_FRAC, SAMPLE_SEED, DISTANCE_METHOD))
+    def order_table(artifacts, districts):
+        if artifacts:
+            return artifacts.orders()
+        # Архив читаем кусками и сразу делаем выборку, потом добавляем день недели, время дня, район и расстояние.
+        # Готовая таблица сохраняется в .cache в формате Arrow, после перезапуска она просто отображается в память
+        return load_orders(DATA_URL, districts, DISTRICT_SOURCES, SAMPLE_FRAC, SAMPLE_SEED, CHUNKSIZE,
+                           DISTANCE_METHOD, ENRICH_WORKERS)
+
+
+    @graph.stage(inputs=['order_table'])
+    def order_store(orders):
+        # Измерения переводим в категории и раскладываем заказы по дню недели и времени дня
+        return OrderStore(orders)
+
+
+    @graph.stage(inputs=['latest_artifacts', 'order_store'])
+    def order_cube(artifacts, store):
+        # Все групповые виды ниже берутся из этого куба, а не из сырых строк
+        if artifacts:
+            return artifacts.cube()
+        return OrderCube.from_orders(store.orders)
+
+
+    @graph.stage(inputs=['latest_artifacts', 'order_store'])
+    def daily_cube(artifacts, store):
+        # Разрезы куба по дням заказов - только для фильтра по периоду
+        if artifacts:
+            return artifacts.daily_cube()
+        return DailyCube.from_orders(store.orders)
+
+
+    @graph.stage(inputs=['order_cube', 'daily_cube'], params=['period'])
+    def range_cube(cube, daily, period):
+        # Куб за выбранный период. За весь период это сам куб со свертками по любым измерениям
+        # (и с заказами без времени), за его часть - суммы из префиксных сумм по разрезам графиков ниже.
+        # Все графики строятся из этого куба, поэтому слайдер периода пересчитывает только их
+        if tuple(period) == daily.days:
+            return cube
+        return daily.between(*period)
+
+
+    @graph.stage(inputs=['order_store'], params=['period'])
+    def period_orders(store, period):
+        # Заказы выбранного периода - срез по отсортированному времени заказа. Этап, чтобы другие виджеты
+        # не копировали таблицу заново при каждом перезапуске
+        return store.between(*period)
+
+
+    @graph.stage(inputs=['latest_artifacts'], fingerprint=lambda: file_stamp([DATA_URL]))
+    def order_preview(artifacts):
+        # Первые заказы архива с днем недели, временем дня и ОС, без районов. Читаются за доли секунды,
+        # поэтому таблица и разбивка по ОС видны сразу, пока районы, куб и карты готовятся в фоне
+        if artifacts:
+            return artifacts.orders()
+        return add_user_agent_features(add_time_features(next(iter_order_chunks(DATA_URL, PREVIEW_ROWS))))
+
+
+    period = None
+    if ready('order_store', 'order_cube', 'daily_cube'):
+        first_day, last_day = graph.get('daily_cube').days
+        dates = st.slider('Период', from_day(first_day), from_day(last_day),
+                          (from_day(first_day), from_day(last_day)))
+        period = (to_day(dates[0]), to_day(dates[1]))
+        df_final = graph.get('period_orders', period=period)
+        cube = graph.get('range_cube', period=period)
+        st.write(df_final[list(ORDER_DTYPES)])
+        # Всего заказов в анализе - по кубу: при сборке по всему архиву в таблице выше только их выборка
+        st.write(cube.count())
+    else:
+        st.write(graph.get('order_preview')[list(ORDER_DTYPES)])
+with st.echo(code_location='below'), stage('enrichment'):
+    """
+        После этого добавим некоторую дополнительную информацию для наших заказов
+        День недели, время дня, административный округ, расстояние до центра Москвы 
+    """
     """Я хочу анализировать только Москву, поэтому удалю заказы не из Москвы"""
-    full_df.dropna(subset=['district'], inplace=True)
-    full_df['day_of_week'].mask(full_df['day_of_week'] == 'Friday', 'Пятница', inplace=True)
-    full_df['day_of_week'].mask(full_df['day_of_week'] == 'Monday', 'Понедельник', inplace=True)
-    full_df['day_of_week'].mask(full_df['day_of_week'] == 'Tuesday', 'Вторник', inplace=True)
-    full_df['day_of_week'].mask(full_df['day_of_week'] == 'Wednesday', 'Среда', inplace=True)
-    full_df['day_of_week'].mask(full_df['day_of_week'] == 'Thursday', 'Четверг', inplace=True)
-    full_df['day_of_week'].mask(full_df['day_of_week'] == 'Saturday', 'Суббота', inplace=True)
-    full_df['day_of_week'].mask(full_df['day_of_week'] == 'Sunday', 'Воскресенье', inplace=True)
-
-
-    @st.experimental_singleton()
-    def final_df():
-        d = full_df.drop(['coords'], axis=1).copy(deep=True)
-        return d
-
-
-    df_final = final_df()
-    df_final
-    sorter = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-    sorterIndex = dict(zip(sorter, range(len(sorter))))
-    df_final['day_of_week_id'] = df_final['day_of_week'].map(sorterIndex)
-    sorter2 = ['утро', 'день', 'вечер', 'ночь']
-    sorterIndex2 = dict(zip(sorter2, range(len(sorter2))))
-    df_final['time_id'] = df_final['Times_of_Day'].map(sorterIndex2)
-    df_final.sort_values(['day_of_week_id', 'time_id'], inplace=True)
-
+    if period is not None:
+        df_final
+with st.echo(code_location='below'), stage('cluster_map'):
     """
     #### Теперь будем рисовать. Давайте сначала просто посмотрим, как наши заказы выглядят на карте 
      """
 
-    m = folium.Map(location=[55.753544, 37.621211], zoom_start=10, width=1200)
-    FastMarkerCluster(
-        data=[[lat, lon] for lat, lon in zip(df_final['location_latitude'], df_final['location_longitude'])]
-        , name='Заказы').add_to(m)
-
-    folium_static(m, width=1200)
+    @graph.stage(inputs=['latest_artifacts', 'order_store'])
+    def cluster_pyramid(artifacts, store):
+        # Кластеры считаем на сервере для всех уровней зума сразу, в браузер уходят только кластеры одного уровня
+        if artifacts:
+            return artifacts.cluster_pyramid()
+        return order_pyramid(store.orders)
+
+
+    @graph.stage(inputs=['latest_artifacts', 'order_store'])
+    def daily_pyramid(artifacts, store):
+        # Кластеры по дням заказов - только грубые уровни, для фильтра по периоду
+        if artifacts:
+            return artifacts.daily_pyramid()
+        return order_pyramid(store.orders, daily=True)
+
+
+    @graph.stage(inputs=['cluster_pyramid', 'daily_pyramid', 'daily_cube'], params=['period'])
+    def range_pyramid(pyramid, daily, daily_cube, period):
+        # За весь период - все уровни, за его часть - уровни, посчитанные по дням
+        if tuple(period) == daily_cube.days:
+            return pyramid
+        return daily.between(*period)
+
+
+    @graph.stage(inputs=['range_pyramid'], params=['zoom'])
+    def cluster_map(pyramid, zoom):
+        # Зависит только от пирамиды и масштаба: другие виджеты страницы карту не перестраивают.
+        # Карта статичная и не сообщает, куда ее сдвинули, поэтому уходит весь уровень: кластеров в нем
+        # не больше, чем ячеек сетки, и при сдвиге карта не пустеет
+        clusters = pyramid.clusters(zoom)
+        m = folium.Map(location=[55.753544, 37.621211], zoom_start=zoom, width=1200)
+        for lat, lon, count in zip(clusters['location_latitude'], clusters['location_longitude'], clusters['count']):
+            folium.CircleMarker([lat, lon], radius=4 + 2 * np.log2(count), tooltip=f'Заказов: {count}'
+                                , fill=True, fill_opacity=0.6, weight=1).add_to(m)
+        return m
+
+
+    if period is not None and ready('cluster_pyramid', 'daily_pyramid'):
+        zooms = graph.get('range_pyramid', period=period).zooms
+        zoom = st.select_slider('Масштаб карты', zooms, value=10)
+        if zooms[-1] < graph.get('cluster_pyramid').zooms[-1]:
+            st.caption(f'За часть периода кластеры есть только до масштаба {zooms[-1]}')
+        folium_static(graph.get('cluster_map', zoom=zoom, period=period), width=1200)
+with st.echo(code_location='below'), stage('choropleth'):
     """#### Давайте посмотрим на заказы в разрезе муниципалитета, административного округа по среднему чеку и по количеству"""
     col1, col2 = st.columns(2)
     with col1:
@@ -163,206 +240,174 @@ with st.echo(code_location='below'):
     with col2:
         option2 = st.selectbox('Как вы хотите их сравнить?', ('Количество заказов', 'Средний чек'))
 
-    if option1 == 'Районы':
-        df_municipalities = (df_final.groupby(['district'], as_index=False)
-                             .agg({'id': 'count', 'amount_charged': 'mean'})
-                             .merge(moscow_geometry_df, on='district', how='left'))
-        geopandas.GeoDataFrame(moscow_geometry_df[['district', 'okrug', 'geometry']]) \
-            .to_file("moscow_geometry.geojson",
-                     driver='GeoJSON')
-        geojson = 'moscow_geometry.geojson'
-        if option2 == 'Количество заказов':
-            merge_col = ['district', 'id']
-            scale = (df_municipalities['id'].quantile((0.5, 0.6, 0.7, 0.8))).tolist()
-            legend = 'Количество заказов'
-        else:
-            merge_col = ['district', 'amount_charged']
-            scale = (df_municipalities['amount_charged'].quantile((0.5, 0.6, 0.7, 0.8))).tolist()
-            legend = 'Средний чек'
-        keys = 'feature.properties.district'
-        ##FROM (https://towardsdatascience.com/folium-and-choropleth-map-from-zero-to-pro-6127f9e68564)
-        # tooltip = folium.features.GeoJson(
-        #     data=df_municipalities.dropna(),
-        #     name=legend,
-        #     smooth_factor=2,
-        #     style_function=lambda x: {'color': 'black', 'fillColor': 'transparent', 'weight': 0.5},
-        #     tooltip=folium.features.GeoJsonTooltip(
-        #         fields=[
-        #             'district',
-        #             'amount_charged',
-        #             'id'],
-        #         aliases=[
-        #             'Район:',
-        #             "Средний чек:",
-        #             "Кол-во заказов:",
-        #         ],
-        #         localize=True,
-        #         sticky=False,
-        #         labels=True,
-        #         style="""
-        #                     background-color: #F0EFEF;
-        #                     border: 2px solid black;
-        #                     border-radius: 3px;
-        #                     box-shadow: 3px;
-        #                 """,
-        #         max_width=800, ), highlight_function=lambda x: {'weight': 3, 'fillColor': 'grey'})
-        ## END
-    elif option1 == 'Округа':
-        df_municipalities = (df_final.groupby(['okrug'], as_index=False)
-                             .agg({'id': 'count', 'amount_charged': 'mean'})
-                             .merge(geopandas.read_file('okruga.geojson')
-                                    , left_on='okrug'
-                                    , right_on='local_name'
-                                    , how='left'))
-        geojson = 'okruga.geojson'
-        if option2 == 'Количество заказов':
-            merge_col = ['okrug', 'id']
-            scale = (df_municipalities['id'].quantile((0.3, 0.5, 0.6, 0.7, 0.8))).tolist()
-            legend = 'Количество заказов'
-        else:
-            merge_col = ['okrug', 'amount_charged']
-            scale = (df_municipalities['amount_charged'].quantile((0.3, 0.5, 0.6, 0.7, 0.8))).tolist()
-            legend = 'Средний чек'
-        keys = 'feature.properties.local_name'
-        ##FROM (https://towardsdatascience.com/folium-and-choropleth-map-from-zero-to-pro-6127f9e68564)
-        # tooltip = folium.features.GeoJson(
-        #     data=df_municipalities.dropna(),
-        #     name=legend,
-        #     smooth_factor=2,
-        #     style_function=lambda x: {'color': 'black', 'fillColor': 'transparent', 'weight': 0.5},
-        #     tooltip=folium.features.GeoJsonTooltip(
-        #         fields=[
-        #             'okrug',
-        #             'amount_charged',
-        #             'id'],
-        #         aliases=[
-        #             'Адм. округ:',
-        #             "Средний чек:",
-        #             "Кол-во заказов:",
-        #         ],
-        #         localize=True,
-        #         sticky=False,
-        #         labels=True,
-        #         style="""
-        #                             background-color: #F0EFEF;
-        #                             border: 2px solid black;
-        #                             border-radius: 3px;
-        #                             box-shadow: 3px;
-        #                         """,
-        #         max_width=800),
-        #     highlight_function=lambda x: {'weight': 3, 'fillColor': 'grey'}
-        # )
-        ##END
-
-    map = folium.Map(location=[55.753544, 37.621211], zoom_start=10, width=1200)
-
-    cho = folium.Choropleth(geo_data=geojson, data=df_municipalities, columns=merge_col
-                            , key_on=keys
-                            , fill_color='YlOrRd'
-                            , nan_fill_color="White"
-                            , legend_name=legend
-                            , tooltip='amount_charged'
-
-                            ).add_to(map)
-    folium_static(map, width=1200)
-
+    @graph.stage(inputs=['latest_artifacts', 'district_table'])
+    def boundary_layers(artifacts, districts):
+        # Границы читаем и переводим в GeoJSON один раз на процесс, сразу в нескольких степенях упрощения
+        if artifacts:
+            return artifacts.boundary_layers()
+        okruga = geopandas.read_file('okruga.geojson')
+        okruga = okruga[okruga['local_name'].isin(districts['okrug'])][['local_name', 'geometry']]
+        return {'Округа': geojson_layers(okruga),
+                'Районы': geojson_layers(districts[['district', 'okrug', 'geometry']])}
+
+
+    @graph.stage(inputs=['range_cube', 'boundary_layers'], params=['option1', 'option2'])
+    def choropleth_map(cube, boundary_layers, option1, option2):
+        if option1 == 'Районы':
+            df_municipalities = cube.rollup(['district'])
+            geojson = boundary_layers['Районы'][BOUNDARY_DETAIL]
+            if option2 == 'Количество заказов':
+                merge_col = ['district', 'id']
+                scale = (df_municipalities['id'].quantile((0.5, 0.6, 0.7, 0.8))).tolist()
+                legend = 'Количество заказов'
+            else:
+                merge_col = ['district', 'amount_charged']
+                scale = (df_municipalities['amount_charged'].quantile((0.5, 0.6, 0.7, 0.8))).tolist()
+                legend = 'Средний чек'
+            keys = 'feature.properties.district'
+            ##FROM (https://towardsdatascience.com/folium-and-choropleth-map-from-zero-to-pro-6127f9e68564)
+            # tooltip = folium.features.GeoJson(
+            #     data=df_municipalities.dropna(),
+            #     name=legend,
+            #     smooth_factor=2,
+            #     style_function=lambda x: {'color': 'black', 'fillColor': 'transparent', 'weight': 0.5},
+            #     tooltip=folium.features.GeoJsonTooltip(
+            #         fields=[
+            #             'district',
+            #             'amount_charged',
+            #             'id'],
+            #         aliases=[
+            #             'Район:',
+            #             "Средний чек:",
+            #             "Кол-во заказов:",
+            #         ],
+            #         localize=True,
+            #         sticky=False,
+            #         labels=True,
+            #         style="""
+            #                     background-color: #F0EFEF;
+            #                     border: 2px solid black;
+            #                     border-radius: 3px;
+            #                     box-shadow: 3px;
+            #                 """,
+            #         max_width=800, ), highlight_function=lambda x: {'weight': 3, 'fillColor': 'grey'})
+            ## END
+        elif option1 == 'Округа':
+            df_municipalities = cube.rollup(['okrug'])
+            geojson = boundary_layers['Округа'][BOUNDARY_DETAIL]
+            if option2 == 'Количество заказов':
+                merge_col = ['okrug', 'id']
+                scale = (df_municipalities['id'].quantile((0.3, 0.5, 0.6, 0.7, 0.8))).tolist()
+                legend = 'Количество заказов'
+            else:
+                merge_col = ['okrug', 'amount_charged']
+                scale = (df_municipalities['amount_charged'].quantile((0.3, 0.5, 0.6, 0.7, 0.8))).tolist()
+                legend = 'Средний чек'
+            keys = 'feature.properties.local_name'
+            ##FROM (https://towardsdatascience.com/folium-and-choropleth-map-from-zero-to-pro-6127f9e68564)
+            # tooltip = folium.features.GeoJson(
+            #     data=df_municipalities.dropna(),
+            #     name=legend,
+            #     smooth_factor=2,
+            #     style_function=lambda x: {'color': 'black', 'fillColor': 'transparent', 'weight': 0.5},
+            #     tooltip=folium.features.GeoJsonTooltip(
+            #         fields=[
+            #             'okrug',
+            #             'amount_charged',
+            #             'id'],
+            #         aliases=[
+            #             'Адм. округ:',
+            #             "Средний чек:",
+            #             "Кол-во заказов:",
+            #         ],
+            #         localize=True,
+            #         sticky=False,
+            #         labels=True,
+            #         style="""
+            #                             background-color: #F0EFEF;
+            #                             border: 2px solid black;
+            #                             border-radius: 3px;
+            #                             box-shadow: 3px;
+            #                         """,
+            #         max_width=800),
+            #     highlight_function=lambda x: {'weight': 3, 'fillColor': 'grey'}
+            # )
+            ##END
+
+        map = folium.Map(location=[55.753544, 37.621211], zoom_start=10, width=1200)
+
+        cho = folium.Choropleth(geo_data=geojson, data=df_municipalities, columns=merge_col
+                                , key_on=keys
+                                , fill_color='YlOrRd'
+                                , nan_fill_color="White"
+                                , legend_name=legend
+                                , tooltip='amount_charged'
+
+                                ).add_to(map)
+        return map
+
+
+    if period is not None and ready('boundary_layers'):
+        folium_static(graph.get('choropleth_map', option1=option1, option2=option2, period=period), width=1200)
+with st.echo(code_location='below'), stage('weekday_chart'):
     '''#### Теперь давайте посмотрим на заказы в разрезе дня недели и времени дня'''
-    df_weekday_time = df_final.groupby(['day_of_week', 'Times_of_Day'], as_index=False) \
-        .agg({'id': 'count', 'amount_charged': 'mean'})
-
-    # df_weekday_time['day_of_week'].mask(df_weekday_time['day_of_week'] == 'Friday', 'Пятница', inplace=True)
-    # df_weekday_time['day_of_week'].mask(df_weekday_time['day_of_week'] == 'Monday', 'Понедельник', inplace=True)
-    # df_weekday_time['day_of_week'].mask(df_weekday_time['day_of_week'] == 'Tuesday', 'Вторник', inplace=True)
-    # df_weekday_time['day_of_week'].mask(df_weekday_time['day_of_week'] == 'Wednesday', 'Среда', inplace=True)
-    # df_weekday_time['day_of_week'].mask(df_weekday_time['day_of_week'] == 'Thursday', 'Четверг', inplace=True)
-    # df_weekday_time['day_of_week'].mask(df_weekday_time['day_of_week'] == 'Saturday', 'Суббота', inplace=True)
-    # df_weekday_time['day_of_week'].mask(df_weekday_time['day_of_week'] == 'Sunday', 'Воскресенье', inplace=True)
-    ## FROM (http://blog.quizzicol.com/2016/10/03/sorting-dates-in-python-by-day-of-week/)
-    sorter = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-    sorterIndex = dict(zip(sorter, range(len(sorter))))
-    df_weekday_time['day_of_week_id'] = df_weekday_time['day_of_week'].map(sorterIndex)
-
-    sorter2 = ['утро', 'день', 'вечер', 'ночь']
-    sorterIndex2 = dict(zip(sorter2, range(len(sorter2))))
-    df_weekday_time['time_id'] = df_weekday_time['Times_of_Day'].map(sorterIndex2)
-    df_weekday_time.sort_values(['day_of_week_id', 'time_id'], inplace=True)
-    ## END
+    @graph.stage(inputs=['range_cube', 'district_table'], params=['view'])
+    def weekday_figure(cube, districts, view):
+        # Пары измерений для анимации - ANIMATED_VIEWS в начале файла
+        frame_dim, x_dim, frame_title, x_title = ANIMATED_VIEWS[view]
+        dimension_order = {'day_of_week': WEEKDAYS, 'Times_of_Day': TIMES_OF_DAY,
+                           'okrug': sorted(districts['okrug'].unique())}
+        return animated_bars(cube.rollup([frame_dim, x_dim]), frame_dim, x_dim,
+                             dimension_order[frame_dim], dimension_order[x_dim],
+                             title=f"Количество заказов и средний чек: {view.lower()}",
+                             frame_title=frame_title, x_title=x_title)
+
+
+    view = st.selectbox('Что анимировать?', list(ANIMATED_VIEWS))
+    if period is not None and ready('district_table'):
+        st.plotly_chart(graph.get('weekday_figure', view=view, period=period))
+with st.echo(code_location='below'), stage('pydeck_maps'):
+    """#### Теперь давайте посмотрим на тоже самое на карте"""
 
-    fig1 = go.Figure(data=[go.Bar(name='Количество заказов', x=
-    df_weekday_time[df_weekday_time['day_of_week'] == list(df_weekday_time['day_of_week'].unique())[0]]['Times_of_Day']
-                                  , y=df_weekday_time[
-            df_weekday_time['day_of_week'] == list(df_weekday_time['day_of_week'].unique())[0]]['id'], yaxis='y'
-                                  , offsetgroup=1)
-        , go.Bar(name='Cредний чек', x=df_weekday_time[
-            df_weekday_time['day_of_week'] == list(df_weekday_time['day_of_week'].unique())[0]]['Times_of_Day']
-                 , y=df_weekday_time[
-                df_weekday_time['day_of_week'] == list(df_weekday_time['day_of_week'].unique())[0]]['amount_charged']
-                 , yaxis="y2", offsetgroup=2)])
-
-    frames = []
-    steps = []
-    for days in list(df_weekday_time['day_of_week'].unique())[1:]:
-        df_weekday_time_day = df_weekday_time[df_weekday_time['day_of_week'] == days]
-        frames.append(go.Frame(data=[go.Bar(name='Количество заказов', x=df_weekday_time_day['Times_of_Day']
-                                            , y=df_weekday_time_day['id'], yaxis='y'
-                                            , offsetgroup=1)
-            , go.Bar(name='Cредний чек', x=df_weekday_time_day['Times_of_Day']
-                     , y=df_weekday_time_day['amount_charged'], yaxis="y2", offsetgroup=2)], name=days))
-    for days in list(df_weekday_time['day_of_week'].unique()):
-        step = dict(
-            label=days,
-            method="animate",
-            args=[[days]]
-        )
-        steps.append(step)
-    sliders = [dict(
-        currentvalue={"prefix": "День недели: ", "font": {"size": 16}},
-        len=0.9,
-        x=0.1,
-        pad={"b": 10, "t": 50},
-        steps=steps,
-    )]
-    fig1.update_layout(title="Количество заказов и средний чек по дням недели",
-                       barmode='group',
-
-                       xaxis_title="Время дня",
-                       yaxis=dict(
-                           title="Количество заказов"
-                       ),
-                       yaxis2=dict(
-                           title="Средний чек",
-                           overlaying="y",
-                           side="right"
-                       ),
-                       ##FROM (https://habr.com/ru/post/502958/)
-                       updatemenus=[dict(direction="left",
-                                         pad={"r": 10, "t": 80},
-                                         x=0.1,
-                                         xanchor="right",
-                                         y=0,
-                                         yanchor="top",
-                                         showactive=False,
-                                         type="buttons",
-                                         buttons=[dict(label="►", method="animate", args=[None, {"fromcurrent": True}]),
-                                                  dict(label="❚❚", method="animate",
-                                                       args=[[None], {"frame": {"duration": 0, "redraw": False},
-                                                                      "mode": "immediate",
-                                                                      "transition": {"duration": 0}}])])],
-                       ##END
-                       legend_x=1.12, width=1200
-                       )
-
-    fig1.layout.sliders = sliders
-    fig1.frames = frames
-    st.plotly_chart(fig1)
 
-    """#### Теперь давайте посмотрим на тоже самое на карте"""
+    @graph.stage(inputs=['latest_artifacts', 'order_store'])
+    def hexbin_cells(artifacts, store):
+        # Заказы раскладываем по шестиугольникам на сервере один раз для каждого дня недели и времени дня,
+        # в браузер уходят только центры ячеек и количество заказов в них
+        return artifacts.hexbins() if artifacts else hexbin_table(slice_hexbins(store, HEX_RADIUS))
+
+
+    @graph.stage(inputs=['latest_artifacts', 'order_store'])
+    def daily_hexbin_index(artifacts, store):
+        # Для фильтра по периоду - крупные шестиугольники по дням заказов
+        cells = artifacts.daily_hexbins() if artifacts else hexbin_table(slice_hexbins(store, HEX_RADIUS, daily=True))
+        return PrefixSums(cells, ['day_of_week', 'Times_of_Day', 'q', 'r'], ['count'])
+
+
+    def period_hex_radius(daily_cube, period):
+        # За весь период шестиугольники подробные, за его часть - с грубой сетки по дням
+        return HEX_RADIUS if tuple(period) == daily_cube.days else HEX_RADIUS * DAILY_HEX_SCALE
 
 
-    ## From (https://github.com/streamlit/demo-uber-nyc-pickups/blob/main/streamlit_app.py)
-    def get_map(data):
-        st.pydeck_chart(
-            pdk.Deck(
+    @graph.stage(inputs=['hexbin_cells', 'daily_hexbin_index', 'daily_cube'], params=['period'])
+    def range_hexbins(cells, index, daily_cube, period):
+        radius = period_hex_radius(daily_cube, period)
+        if radius != HEX_RADIUS:
+            cells = index.between(*period)
+        lat, lon = hex_centers(cells['q'].to_numpy(), cells['r'].to_numpy(), radius)
+        return cells.assign(location_latitude=lat, location_longitude=lon)
+
+
+    @graph.stage(inputs=['range_hexbins', 'daily_cube'], params=['day', 'period'])
+    def day_decks(cells, daily_cube, day, period):
+        # Слайдер дня недели перестраивает только эти четыре слоя
+        ## From (https://github.com/streamlit/demo-uber-nyc-pickups/blob/main/streamlit_app.py)
+        def get_map(data):
+            # Ячейки уже посчитаны на сервере, поэтому рисуем их как есть шестигранными столбиками:
+            # HexagonLayer заново раскладывал бы центры по своей сетке, и соседние ячейки сливались бы.
+            # Высота и цвет - доля от самой заполненной ячейки, как делал HexagonLayer
+            top = max(int(data['count'].max()), 1) if len(data) else 1
+            return pdk.Deck(
                 map_style="mapbox://styles/mapbox/light-v9",
                 initial_view_state={
                     "latitude": 55.753544,
@@ -372,125 +417,105 @@ with st.echo(code_location='below'):
                 },
                 layers=[
                     pdk.Layer(
-                        "HexagonLayer",
+                        "ColumnLayer",
                         data=data,
                         get_position=["location_longitude", "location_latitude"],
-                        radius=120,
-                        elevation_scale=4,
-                        elevation_range=[0, 1000],
+                        get_elevation="count",
+                        get_fill_color=f"[255, 255 * (1 - count / {top}), 64, 200]",
+                        disk_resolution=6,
+                        angle=90,
+                        radius=radius,
+                        elevation_scale=4 * 1000 / top,
                         pickable=True,
                         extruded=True,
                     ),
                 ],
-            ), use_container_width=True
-        )
-
-
-    ## End
-
-    day = st.select_slider('Выберете день недели', df_final['day_of_week'].unique())
-    ## если что это не я дурак, а пандас, потому что не находил иначе нужную часть датасета
-    if day == 'Понедельник':
-        query1 = 'day_of_week=="Понедельник" and Times_of_Day=="утро"'
-        query2 = 'day_of_week=="Понедельник" and Times_of_Day=="день"'
-        query3 = 'day_of_week=="Понедельник" and Times_of_Day=="вечер"'
-        query4 = 'day_of_week=="Понедельник" and Times_of_Day=="ночь"'
-    elif day == 'Вторник':
-        query1 = 'day_of_week=="Вторник" and Times_of_Day=="утро"'
-        query2 = 'day_of_week=="Вторник" and Times_of_Day=="день"'
-        query3 = 'day_of_week=="Вторник" and Times_of_Day=="вечер"'
-        query4 = 'day_of_week=="Вторник" and Times_of_Day=="ночь"'
-    elif day == 'Среда':
-        query1 = 'day_of_week=="Среда" and Times_of_Day=="утро"'
-        query2 = 'day_of_week=="Среда" and Times_of_Day=="день"'
-        query3 = 'day_of_week=="Среда" and Times_of_Day=="вечер"'
-        query4 = 'day_of_week=="Среда" and Times_of_Day=="ночь"'
-    elif day == 'Четверг':
-        query1 = 'day_of_week=="Четверг" and Times_of_Day=="утро"'
-        query2 = 'day_of_week=="Четверг" and Times_of_Day=="день"'
-        query3 = 'day_of_week=="Четверг" and Times_of_Day=="вечер"'
-        query4 = 'day_of_week=="Четверг" and Times_of_Day=="ночь"'
-    elif day == 'Пятница':
-        query1 = 'day_of_week=="Пятница" and Times_of_Day=="утро"'
-        query2 = 'day_of_week=="Пятница" and Times_of_Day=="день"'
-        query3 = 'day_of_week=="Пятница" and Times_of_Day=="вечер"'
-        query4 = 'day_of_week=="Пятница" and Times_of_Day=="ночь"'
-    elif day == 'Суббота':
-        query1 = 'day_of_week=="Суббота" and Times_of_Day=="утро"'
-        query2 = 'day_of_week=="Суббота" and Times_of_Day=="день"'
-        query3 = 'day_of_week=="Суббота" and Times_of_Day=="вечер"'
-        query4 = 'day_of_week=="Суббота" and Times_of_Day=="ночь"'
-    elif day == 'Воскресенье':
-        query1 = 'day_of_week=="Воскресенье" and Times_of_Day=="утро"'
-        query2 = 'day_of_week=="Воскресенье" and Times_of_Day=="день"'
-        query3 = 'day_of_week=="Воскресенье" and Times_of_Day=="вечер"'
-        query4 = 'day_of_week=="Воскресенье" and Times_of_Day=="ночь"'
-
-    morning, day = st.columns(2)
-    with morning:
-        """#### Утро"""
-        df_morn = df_final.query(query1).dropna(subset=["location_longitude", "location_latitude"])
-        get_map(df_morn)
-        """#### Вечер"""
-        df_day = df_final.query(query3).dropna(subset=["location_longitude", "location_latitude"])
-        get_map(df_day)
-    with day:
-        """#### День"""
-        df_eve = df_final.query(query2).dropna(subset=["location_longitude", "location_latitude"])
-        get_map(df_eve)
-        """#### Ночь"""
-        df_night = df_final.query(query4).dropna(subset=["location_longitude", "location_latitude"])
-        get_map(df_night)
-
-    """### Теперь давайте посмотрим на зависимость среднего чека и количество заказов от расстояния до центра"""
-    df_dist = df_final.query('distance_from_center<30')
-    df_dist['distance_from_center'] = df_dist['distance_from_center'].round(1)
-    coll1, coll2 = st.columns(2)
-    with coll1:
-        """#### По среднему чеку"""
-        ## From(https://altair-viz.github.io/gallery/poly_fit_regression.html
-        base = alt.Chart(df_dist).mark_circle(color="black").encode(
-            alt.X("distance_from_center"), alt.Y("amount_charged"))
-        polynomial_fit = [
-            base.transform_regression(
-                "distance_from_center", "amount_charged", method="poly", order=order,
-                as_=["distance_from_center", str(order)]
-            )
-                .mark_line()
-                .transform_fold([str(order)], as_=["degree", "amount_charged"])
-                .encode(alt.Color("degree:N"))
-            for order in [1, 3, 5]]
-        # end
-        st.altair_chart(alt.layer(base, *polynomial_fit))
-    with coll2:
-        """#### Количество заказов"""
-        
-        df_dist_2 = df_dist.groupby('distance_from_center', as_index=False).agg({'id': 'count'})
-        df_dist_2['distance_from_center'] = np.round(df_dist_2['distance_from_center'], 0)
-        base = alt.Chart(df_dist.groupby('distance_from_center', as_index=False).agg({'id': 'count'})).mark_circle(
-            color="black").encode(
-            alt.X("distance_from_center"), alt.Y("id"))
-        polynomial_fit = [
-            base.transform_regression(
-                "distance_from_center", "count", method="poly", order=order,
-                as_=["distance_from_center", str(order)]
             )
-                .mark_line()
-                .transform_fold([str(order)], as_=["degree", "id"])
-                .encode(alt.Color("degree:N"))
-            for order in [1, 3, 5]]
-        # end
-        st.altair_chart(alt.layer(base, *polynomial_fit))
-
+        ## End
+
+        radius = period_hex_radius(daily_cube, period)
+        cells = cells[cells['day_of_week'] == day]
+        return {time_of_day: get_map(cells[cells['Times_of_Day'] == time_of_day][
+                    ['count', 'location_latitude', 'location_longitude']])
+                for time_of_day in TIMES_OF_DAY}
+
+
+    day = st.select_slider('Выберете день недели', WEEKDAYS)
+    if period is not None and ready('hexbin_cells', 'daily_hexbin_index'):
+        decks = graph.get('day_decks', day=day, period=period)
+        if period_hex_radius(graph.get('daily_cube'), period) != HEX_RADIUS:
+            st.caption('За часть периода шестиугольники крупнее: по дням заказы хранятся только на грубой сетке')
+
+        morning, afternoon = st.columns(2)
+        with morning:
+            """#### Утро"""
+            st.pydeck_chart(decks['утро'], use_container_width=True)
+            """#### Вечер"""
+            st.pydeck_chart(decks['вечер'], use_container_width=True)
+        with afternoon:
+            """#### День"""
+            st.pydeck_chart(decks['день'], use_container_width=True)
+            """#### Ночь"""
+            st.pydeck_chart(decks['ночь'], use_container_width=True)
+with st.echo(code_location='below'), stage('distance_charts'):
+    """### Теперь давайте посмотрим на зависимость среднего чека и количество заказов от расстояния до центра"""
+    @graph.stage(inputs=['range_cube'])
+    def distance_table(cube):
+        return distance_bins(cube.totals(['distance_bucket']), max_distance=30)
+
+
+    @graph.stage(inputs=['distance_table'])
+    def distance_fits(bins):
+        # Полиномы 1, 3 и 5 степени считаются на сервере по корзинам расстояния, а не в браузере по всем заказам.
+        # Ключ кеша - отпечаток куба, так что при новых данных кривые пересчитаются
+        return (binned_regression(bins, 'distance_from_center', 'amount_charged', 'id', spread='amount_sd',
+                                  n_boot=DISTANCE_FIT_BOOTSTRAP),
+                binned_regression(bins, 'distance_from_center', 'id', 'id', n_boot=DISTANCE_FIT_BOOTSTRAP))
+
+
+    def fit_chart(points, fits, y):
+        base = alt.Chart(points).mark_circle(color="black").encode(alt.X("distance_from_center"), alt.Y(y))
+        lines = alt.Chart(fits).mark_line().encode(alt.X("distance_from_center"), alt.Y(y), alt.Color("degree:N"))
+        layers = [base, lines]
+        if 'lower' in fits:
+            layers.insert(1, alt.Chart(fits).mark_area(opacity=0.2).encode(
+                alt.X("distance_from_center"), alt.Y("lower", title=y), alt.Y2("upper"), alt.Color("degree:N")))
+        return alt.layer(*layers)
+
+
+    if period is not None:
+        df_dist = graph.get('distance_table', period=period)
+        amount_fits, count_fits = graph.get('distance_fits', period=period)
+        coll1, coll2 = st.columns(2)
+        with coll1:
+            """#### По среднему чеку"""
+            st.altair_chart(fit_chart(df_dist[['distance_from_center', 'amount_charged']], amount_fits,
+                                      "amount_charged"))
+        with coll2:
+            """#### Количество заказов"""
+            st.altair_chart(fit_chart(df_dist[['distance_from_center', 'id']], count_fits, "id"))
+
+with st.echo(code_location='below'), stage('os_charts'):
     """### Посмотрим пользователи каких устройств больше пользуются Яндекс Едой"""
-    df_final['os'] = 'Other'
-    df_final['os'].mask(df_final['user_agent'].str.lower().str.contains('ios'), 'IOS', inplace=True)
-    df_final['os'].mask(df_final['user_agent'].str.lower().str.contains('iphone'), 'IOS', inplace=True)
-    df_final['os'].mask(df_final['user_agent'].str.lower().str.contains('macintosh'), 'Mac OS X', inplace=True)
-    df_final['os'].mask(df_final['user_agent'].str.lower().str.contains('windows'), 'Windows', inplace=True)
-    df_final['os'].mask(df_final['user_agent'].str.lower().str.contains('android'), 'Android', inplace=True)
-    df_os = df_final.groupby('os', as_index=False).agg({'id': 'count'})
-    df_os.rename(columns={'os': 'name', 'id': 'value'}, inplace=True)
+    @graph.stage(inputs=['range_cube'])
+    def os_totals(cube):
+        # Колонка os считается при подготовке таблицы по таблице правил, см. useragent.UA_RULES
+        return cube.rollup(['os'])
+
+
+    @graph.stage(inputs=['order_preview'])
+    def os_preview(orders):
+        # Пока куб готовится - та же разбивка по первым заказам архива, еще без отсева заказов вне Москвы
+        return orders.groupby('os', as_index=False, observed=True).agg(id=('id', 'count'),
+                                                                        amount_charged=('amount_charged', 'mean'))
+
+
+    if period is not None:
+        os_frame = graph.get('os_totals', period=period)
+    else:
+        st.caption('Предварительно: по первым заказам архива, пока идет полная подготовка')
+        os_frame = graph.get('os_preview')
+    df_os = os_frame[['os', 'id']].rename(columns={'os': 'name', 'id': 'value'})
     ## From (https://share.streamlit.io/andfanilo/streamlit-echarts-demo/master/app.py)
     options = {
         "tooltip": {"trigger": "item"},
@@ -520,7 +545,7 @@ with st.echo(code_location='below'):
     )
     ## END
     """### А пользователи каких устройств больше платят в среднем?"""
-    df_os_charge = df_final.groupby('os', as_index=False).agg({'amount_charged': 'mean'})
+    df_os_charge = os_frame[['os', 'amount_charged']]
     ##From (https://echarts.apache.org/examples/en/editor.html?c=bar-simple&lang=js)
     options = {
         "tooltip": {"trigger": "item"},
@@ -543,3 +568,33 @@ with st.echo(code_location='below'):
         options=options, height="500px",
     )
 
+# Фоновые этапы, досчитанные уже после отрисовки прошлого прогона, попадают в замеры этого
+jobs = {**jobs, **st.session_state.pop('pending_stages', {})}
+if instrumentation.enabled():
+    # Фоновые этапы считаются в потоках пула, и их замеры приходят вместе с результатом
+    for job in jobs.values():
+        if job.done():
+            instrumentation.records().extend(job.records)
+    # Замеры этого прогона: таблица в сайдбаре и выгрузка в JSON lines для сравнения между выкладками
+    run_log = instrumentation.to_json_lines(run=uuid.uuid4().hex)
+    if PROFILE_LOG:
+        with open(PROFILE_LOG, 'a', encoding='utf-8') as log:
+            log.write(run_log)
+    with st.sidebar:
+        st.markdown('### Замеры этапов')
+        st.dataframe(instrumentation.records())
+        st.download_button('Скачать JSON lines', run_log, file_name='stages.jsonl')
+
+pending = {name: job for name, job in jobs.items() if not job.done()}
+st.session_state['pending_stages'] = pending
+if pending:
+    # Пока фоновая подготовка идет, показываем ее прогресс, а как только готов очередной этап,
+    # перезапускаем страницу - появятся разделы, которым хватает готовых данных
+    while True:
+        with progress_slot.container():
+            st.progress(graph.progress(list(pending)))
+            st.caption('Идет подготовка данных: ' + ', '.join(graph.running()))
+        finished, _ = wait(list(pending.values()), timeout=PROGRESS_POLL, return_when=FIRST_COMPLETED)
+        if finished:
+            break
+    st.experimental_rerun()
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+# Читаем только нужные колонки и сразу с нужными типами, чтобы pandas не угадывал их по всему файлу
+ORDER_DTYPES = {
+    'id': 'int64',
+    'created_at': 'object',
+    'amount_charged': 'float64',
+    'user_agent': 'object',
+    'location_latitude': 'float64',
+    'location_longitude': 'float64',
+}
+
+
+def iter_order_chunks(path, chunksize, columns=None):
+    """Распаковывает и разбирает архив кусками по chunksize строк."""
+    columns = list(columns or ORDER_DTYPES)
+    return pd.read_csv(path, usecols=columns, dtype={c: ORDER_DTYPES[c] for c in columns},
+                       chunksize=chunksize)
+
+
+def iter_budgeted_chunks(path, memory_budget, columns=None, overhead=4, first_chunk=10_000, reserved=None):
+    """Куски архива такого размера, чтобы кусок со всеми промежуточными копиями при обогащении
+    (overhead - во сколько раз они больше сырого куска) укладывался в memory_budget байт.
+    Размер подбирается по реальному весу строки предыдущего куска.
+    reserved() - сколько байт уже заняло то, что вызывающий копит между кусками; кусок берется из остатка."""
+    columns = list(columns or ORDER_DTYPES)
+    reader = pd.read_csv(path, usecols=columns, dtype={c: ORDER_DTYPES[c] for c in columns}, iterator=True)
+    size = first_chunk
+    with reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(size)
+            except StopIteration:
+                return
+            yield chunk
+            row_bytes = chunk.memory_usage(deep=True).sum() / max(len(chunk), 1)
+            free = memory_budget - (reserved() if reserved else 0)
+            if free <= 0:
+                raise MemoryError(f'Накопленное между кусками уже занимает весь бюджет памяти: {memory_budget} байт')
+            size = max(1_000, int(free / overhead / row_bytes))
+
+
+class Reservoir:
+    """Равномерная выборка ровно size строк из потока кусков: каждой строке дается случайный ключ,
+    и хранятся size строк с наименьшими ключами. Память - size строк плюс один кусок."""
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.rows = None
+        self.keys = np.empty(0)
+
+    def add(self, chunk):
+        self.rows = chunk if self.rows is None else pd.concat([self.rows, chunk])
+        self.keys = np.concatenate([self.keys, self.rng.random(len(chunk))])
+        if len(self.keys) > self.size:
+            keep = np.sort(np.argpartition(self.keys, self.size)[:self.size])
+            self.rows, self.keys = self.rows.iloc[keep], self.keys[keep]
+
+
+def read_orders(path, frac=None, size=None, seed=None, chunksize=200_000, columns=None):
+    """Читает выборку заказов, не держа в памяти весь файл.
+
+    frac - бернуллиевская выборка: каждая строка попадает в нее с вероятностью frac.
+    size - резервуарная выборка ровно size строк (или меньше, если строк меньше).
+    Без frac и size читает все строки. Пиковая память ограничена размером выборки плюс один кусок.
+    """
+    if frac is not None and size is not None:
+        raise ValueError('Pass either frac or size, not both')
+    rng = np.random.default_rng(seed)
+    parts = []
+    if size is not None:
+        reservoir = Reservoir(size, rng)
+        for chunk in iter_order_chunks(path, chunksize, columns):
+            reservoir.add(chunk)
+        parts = [] if reservoir.rows is None else [reservoir.rows]
+    else:
+        for chunk in iter_order_chunks(path, chunksize, columns):
+            if frac is not None:
+                chunk = chunk[rng.random(len(chunk)) < frac]
+            parts.append(chunk)
+    if not parts:
+        return pd.DataFrame({c: pd.Series(dtype=ORDER_DTYPES[c]) for c in columns or ORDER_DTYPES})
+    return pd.concat(parts, ignore_index=True)
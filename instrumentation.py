@@ -0,0 +1,152 @@
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Замеры копятся отдельно для каждого потока: streamlit выполняет скрипт каждой сессии в своем потоке
+_local = threading.local()
+_enabled = False
+_memory = False
+# tracemalloc один на процесс: пик памяти общий для всех потоков. Поэтому этапы, которые сейчас меряют память,
+# известны всем потокам, и пик этапа, во время которого работал этап другого потока, не записывается
+_active_lock = threading.Lock()
+_active = []
+
+
+def enable(memory=True):
+    """Включает замеры. Память меряется через tracemalloc, а он заметно замедляет код с большим числом
+    python-объектов, поэтому по умолчанию все выключено, а память можно не мерить (memory=False)."""
+    global _enabled, _memory
+    _enabled = True
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def enabled():
+    return _enabled
+
+
+def records():
+    if not hasattr(_local, 'records'):
+        _local.records = []
+    return _local.records
+
+
+def reset():
+    """Начинает новый прогон скрипта: старые замеры и стек вложенных этапов сбрасываются."""
+    _local.records = []
+    _local.stack = []
+
+
+@contextmanager
+def collect(into):
+    """Замеры внутри блока складываются в список into, а не в замеры текущего прогона.
+    Так этап из фонового потока отдает свои замеры прогону страницы, который ждал его результат."""
+    saved, saved_stack = records(), _local.__dict__.get('stack', [])
+    _local.records, _local.stack = into, []
+    try:
+        yield into
+    finally:
+        _local.records, _local.stack = saved, saved_stack
+
+
+def _size(value):
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Замеряет этап: время, прирост пиковой памяти, строки на входе и выходе, попадание в кеш.
+
+    Внутри блока можно дописать в запись rows_out и cache. Вложенные этапы допустимы:
+    пик памяти вложенного этапа учитывается и во внешнем. Если одновременно шел этап в другом потоке
+    (другая сессия или фоновый этап), пик памяти не определен, и peak_mem_bytes остается None.
+    """
+    record = {'stage': name, 'started_at': time.time(), 'rows_in': rows_in, 'rows_out': None, 'cache': None}
+    if not _enabled:
+        yield record
+        return
+    if not _memory:
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = round(time.perf_counter() - started, 6)
+            record['peak_mem_bytes'] = None
+            records().append(record)
+        return
+    stack = _local.__dict__.setdefault('stack', [])
+    thread = threading.get_ident()
+    with _active_lock:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        frame = {'base': current, 'peak': current, 'thread': thread, 'overlap': False}
+        for other in _active:
+            if other['thread'] != thread:
+                other['overlap'] = frame['overlap'] = True
+        tracemalloc.reset_peak()
+        _active.append(frame)
+    stack.append(frame)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = round(time.perf_counter() - started, 6)
+        with _active_lock:
+            _active.remove(frame)
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, frame['peak'])
+            record['peak_mem_bytes'] = None if frame['overlap'] else max(peak - frame['base'], 0)
+            stack.pop()
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+                stack[-1]['overlap'] = stack[-1]['overlap'] or frame['overlap']
+            tracemalloc.reset_peak()
+        records().append(record)
+
+
+def cached(cache):
+    """Оборачивает кеширующий декоратор streamlit так, чтобы вызов записывался как этап
+    с пометкой hit/miss: miss - если тело функции действительно выполнялось."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def body(*args, **kwargs):
+            misses = _local.__dict__.setdefault('misses', [])
+            if misses:
+                misses[-1] = True
+            return fn(*args, **kwargs)
+
+        cached_fn = cache(body)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return cached_fn(*args, **kwargs)
+            misses = _local.__dict__.setdefault('misses', [])
+            with stage(fn.__name__) as record:
+                misses.append(False)
+                try:
+                    result = cached_fn(*args, **kwargs)
+                finally:
+                    record['cache'] = 'miss' if misses.pop() else 'hit'
+                record['rows_out'] = _size(result)
+            return result
+
+        wrapper.clear = getattr(cached_fn, 'clear', None)
+        return wrapper
+
+    return decorator
+
+
+def to_json_lines(**fields):
+    """Замеры текущего прогона в формате JSON lines, по строке на этап; fields дописываются в каждую строку."""
+    return ''.join(json.dumps(dict(record, **fields), ensure_ascii=False, default=str) + '\n'
+                   for record in records())
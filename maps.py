@@ -0,0 +1,194 @@
+import numpy as np
+import pandas as pd
+
+from enrichment import MOSCOW_CENTER
+from timeindex import DAY_COLUMN, PrefixSums
+
+# Метров в градусе широты
+METERS_PER_DEGREE = 111_320.0
+SQRT3 = np.sqrt(3)
+
+
+def to_meters(lat, lon, center=MOSCOW_CENTER):
+    """Плоская проекция вокруг центра Москвы - в пределах города искажение меньше процента."""
+    c_lat, c_lon = center
+    x = (np.asarray(lon, dtype='float64') - c_lon) * METERS_PER_DEGREE * np.cos(np.radians(c_lat))
+    y = (np.asarray(lat, dtype='float64') - c_lat) * METERS_PER_DEGREE
+    return x, y
+
+
+def to_degrees(x, y, center=MOSCOW_CENTER):
+    c_lat, c_lon = center
+    lon = c_lon + np.asarray(x) / (METERS_PER_DEGREE * np.cos(np.radians(c_lat)))
+    lat = c_lat + np.asarray(y) / METERS_PER_DEGREE
+    return lat, lon
+
+
+def hex_cells(lat, lon, radius):
+    """Осевые координаты (q, r) шестиугольника радиуса radius метров для каждой точки."""
+    x, y = to_meters(lat, lon)
+    q = (SQRT3 / 3 * x - y / 3) / radius
+    r = (2 / 3 * y) / radius
+    # Округление в кубических координатах, чтобы точка попала в ближайший центр
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype('int32'), rr.astype('int32')
+
+
+def hex_centers(q, r, radius):
+    x = radius * SQRT3 * (np.asarray(q) + np.asarray(r) / 2)
+    y = radius * 1.5 * np.asarray(r)
+    return to_degrees(x, y)
+
+
+def hexbin(lat, lon, radius=120, days=None):
+    """Считает заказы в шестиугольниках радиуса radius метров.
+
+    Возвращает по строке на непустую ячейку: q, r, центр ячейки и количество заказов.
+    Если заданы days (номера дней заказов), ячейки считаются отдельно по дням - в колонке order_day,
+    чтобы потом брать любой интервал дат через PrefixSums. Куски данных складываются через merge_hexbins.
+    """
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    q, r = hex_cells(lat[valid], lon[valid], radius)
+    keys = {'q': q, 'r': r}
+    if days is not None:
+        keys = {DAY_COLUMN: np.asarray(days)[valid], **keys}
+    cells = pd.DataFrame(keys).groupby(list(keys), as_index=False).size()
+    return _with_centers(cells.rename(columns={'size': 'count'}), radius)
+
+
+def merge_hexbins(parts, radius=120):
+    keys = [key for key in (DAY_COLUMN, 'q', 'r') if key in parts[0]]
+    cells = pd.concat([p[keys + ['count']] for p in parts]).groupby(keys, as_index=False)['count'].sum()
+    return _with_centers(cells, radius)
+
+
+def _with_centers(cells, radius):
+    lat, lon = hex_centers(cells['q'].to_numpy(), cells['r'].to_numpy(), radius)
+    return cells.assign(location_latitude=lat, location_longitude=lon)
+
+
+# Уровни упрощения границ в градусах: 0.0005 - около 30-50 м, 0.002 - около 120-200 м
+SIMPLIFY_TOLERANCES = {'full': 0, 'medium': 0.0005, 'coarse': 0.002}
+
+
+def geojson_layers(boundaries, tolerances=SIMPLIFY_TOLERANCES):
+    """Готовые GeoJSON-строки для folium на каждом уровне упрощения.
+
+    Упрощение сохраняет топологию каждого полигона (preserve_topology), а строка сериализуется один раз,
+    так что на перезапуске скрипта не нужно ни читать файл, ни заново переводить геометрию в JSON.
+    """
+    layers = {}
+    for level, tolerance in tolerances.items():
+        layer = boundaries
+        if tolerance:
+            layer = boundaries.assign(geometry=boundaries.geometry.simplify(tolerance, preserve_topology=True))
+        layers[level] = layer.to_json()
+    return layers
+
+
+class ClusterPyramid:
+    """Кластеры заказов для каждого уровня зума, как в supercluster, но на стороне python.
+
+    Точки переводятся в координаты Web Mercator [0, 1), на уровне zoom плоскость режется сеткой
+    с шагом radius пикселей тайла 256x256, и каждая непустая ячейка становится кластером
+    с центром масс и количеством заказов. Суммы координат хранятся, чтобы пирамиды по кускам данных
+    можно было складывать (merge).
+
+    Хранится только самый подробный уровень: ячейка уровня на k меньше - это ячейка подробного,
+    сдвинутая на k бит, так что остальные уровни собираются из него при первом обращении.
+    Поэтому и ячейки по дням заказов (для фильтра по периоду) хранятся один раз, а не копией на каждом уровне.
+    """
+
+    def __init__(self, cells, zooms, radius=60):
+        self.cells = cells
+        self.zooms = list(zooms)
+        self.radius = radius
+        self._levels = {}
+        self._prefix = None
+
+    @staticmethod
+    def _mercator(lat, lon):
+        x = np.asarray(lon) / 360 + 0.5
+        sin = np.sin(np.radians(lat))
+        return x, 0.5 - 0.25 * np.log((1 + sin) / (1 - sin)) / np.pi
+
+    @staticmethod
+    def _cells(x, y, zoom, radius):
+        cell = radius / (256 * 2 ** zoom)
+        return np.floor(x / cell).astype('int32'), np.floor(y / cell).astype('int32')
+
+    @staticmethod
+    def _keys(cells):
+        return [key for key in (DAY_COLUMN, 'cx', 'cy') if key in cells]
+
+    @classmethod
+    def from_points(cls, lat, lon, min_zoom=8, max_zoom=16, radius=60, days=None):
+        """Пирамида по точкам; с days (номерами дней заказов) ячейки считаются отдельно по дням."""
+        lat = np.asarray(lat, dtype='float64')
+        lon = np.asarray(lon, dtype='float64')
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        lat, lon = lat[valid], lon[valid]
+        cx, cy = cls._cells(*cls._mercator(lat, lon), max_zoom, radius)
+        frame = pd.DataFrame({'cx': cx, 'cy': cy, 'lat_sum': lat, 'lon_sum': lon})
+        if days is not None:
+            frame.insert(0, DAY_COLUMN, np.asarray(days)[valid])
+        cells = (frame.groupby(cls._keys(frame))
+                 .agg(count=('lat_sum', 'size'), lat_sum=('lat_sum', 'sum'), lon_sum=('lon_sum', 'sum'))
+                 .reset_index())
+        return cls(cells.astype({'count': 'int32'}), range(min_zoom, max_zoom + 1), radius)
+
+    def level(self, zoom):
+        """Ячейки уровня zoom (без дней): ячейки самого подробного уровня, сдвинутые на разницу зумов."""
+        if zoom not in self._levels:
+            shift = self.zooms[-1] - zoom
+            cells = self.cells.assign(cx=self.cells['cx'].to_numpy() >> shift,
+                                      cy=self.cells['cy'].to_numpy() >> shift)
+            self._levels[zoom] = cells.groupby(['cx', 'cy'], as_index=False)[['count', 'lat_sum', 'lon_sum']].sum()
+        return self._levels[zoom]
+
+    def merge(self, other):
+        cells = (pd.concat([self.cells, other.cells])
+                 .groupby(self._keys(self.cells), as_index=False)[['count', 'lat_sum', 'lon_sum']].sum())
+        return ClusterPyramid(cells, self.zooms, self.radius)
+
+    def between(self, start, end):
+        """Пирамида только по заказам с днем в [start, end] - через префиксные суммы подробного уровня."""
+        if self._prefix is None:
+            self._prefix = PrefixSums(self.cells, ['cx', 'cy'], ['count', 'lat_sum', 'lon_sum'])
+        return ClusterPyramid(self._prefix.between(start, end), self.zooms, self.radius)
+
+    def to_frame(self):
+        return self.cells.assign(zoom=np.int8(self.zooms[-1]))
+
+    @classmethod
+    def from_frame(cls, frame, radius=60, min_zoom=8):
+        max_zoom = int(frame['zoom'].iloc[0]) if len(frame) else min_zoom
+        return cls(frame.drop(columns='zoom'), range(min_zoom, max_zoom + 1), radius)
+
+    def clusters(self, zoom, center=None, size=(1200, 500)):
+        """Кластеры ближайшего посчитанного уровня: широта, долгота центра и количество заказов.
+
+        Если задан center, отдаются только кластеры в окне size пикселей вокруг него (с запасом в экран
+        с каждой стороны), чтобы на крупных масштабах не отправлять в браузер весь город.
+        """
+        zoom = min(max(zoom, self.zooms[0]), self.zooms[-1])
+        cells = self.level(zoom)
+        if center is not None:
+            x, y = self._mercator(*center)
+            world = 256 * 2 ** zoom
+            cell = self.radius / world
+            half_w, half_h = 1.5 * size[0] / world, 1.5 * size[1] / world
+            inside = ((np.abs((cells['cx'] + 0.5) * cell - x) <= half_w)
+                      & (np.abs((cells['cy'] + 0.5) * cell - y) <= half_h))
+            cells = cells[inside]
+        return pd.DataFrame({'location_latitude': cells['lat_sum'] / cells['count'],
+                             'location_longitude': cells['lon_sum'] / cells['count'],
+                             'count': cells['count']})
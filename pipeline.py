@@ -0,0 +1,343 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import geopandas
+import numpy as np
+import pandas as pd
+
+import artifacts
+import cube
+import enrichment
+import ingest
+import maps
+import settings
+import store
+import timeindex
+import useragent
+from artifacts import artifact_path, atomic_write, fingerprint, read_table, write_table
+from cube import DailyCube, OrderCube
+from enrichment import add_sort_ids, add_time_features, enrich_orders, load_district_hierarchy, translate_weekdays
+from ingest import Reservoir, iter_budgeted_chunks, read_orders
+from maps import ClusterPyramid, geojson_layers, hexbin, merge_hexbins
+from store import OrderStore
+from timeindex import DAY_COLUMN
+from useragent import add_user_agent_features
+
+# Меняем руками, если поменялся смысл колонок итоговой таблицы
+ORDERS_VERSION = 1
+# Меняем, когда меняется состав или вид файлов артефактов: страница не станет читать сборку старого формата
+ARTIFACTS_FORMAT = 5
+# Для фильтра по периоду шестиугольники и кластеры хранятся по дням только на грубой сетке: ячеек в ней порядка
+# (площадь города) x (дни), а подробная сетка по дням давала почти по ячейке на заказ. Подробная сетка хранится
+# без дней, за весь период. Шестиугольники по дням в DAILY_HEX_SCALE раз крупнее, кластеры - до зума DAILY_MAX_ZOOM
+DAILY_HEX_SCALE = 8
+DAILY_MAX_ZOOM = 12
+# Модули, от кода которых зависит таблица заказов и все артефакты страницы. Сам pipeline тоже здесь:
+# в нем цепочка подготовки и сборка артефактов, а в artifacts - формат файлов на диске
+ORDERS_MODULES = (ingest, enrichment, timeindex, useragent, artifacts, sys.modules[__name__])
+PIPELINE_MODULES = ORDERS_MODULES + (cube, maps, store)
+
+
+def code_version(*params, modules=ORDERS_MODULES):
+    """Версия кода подготовки: исходники модулей, которые строят таблицу, плюс параметры выборки."""
+    digest = hashlib.sha256(str((ORDERS_VERSION,) + params).encode())
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def prepare_orders(data_url, districts, frac, seed, chunksize, distance_method='ellipsoidal', workers=1):
+    """Вся цепочка подготовки заказов: выборка, время, район и округ, расстояние до центра,
+    ОС, тип устройства и версия приложения."""
+    df = read_orders(data_url, frac=frac, seed=seed, chunksize=chunksize)
+    df = enrich_chunk(df, districts, distance_method, workers)
+    return df.sort_values(['day_of_week_id', 'time_id'], kind='stable', ignore_index=True)
+
+
+def enrich_chunk(df, districts, distance_method='ellipsoidal', workers=1):
+    """Обогащение одного куска сырых заказов; порядок строк сохраняется."""
+    df = add_time_features(df)
+    df = enrich_orders(df, districts, distance_method=distance_method, workers=workers)
+    # Анализируем только Москву, заказы вне районов выкидываем
+    df = df.dropna(subset=['district'])
+    return add_user_agent_features(add_sort_ids(translate_weekdays(df)))
+
+
+def orders_key(data_url, source_paths, *params, modules=ORDERS_MODULES):
+    paths = [data_url] + [path.replace('zip://', '') for path in source_paths]
+    return fingerprint(paths, code_version(*params, modules=modules))
+
+
+def load_orders(data_url, districts, source_paths, frac, seed, chunksize, distance_method='ellipsoidal',
+                workers=1):
+    """Готовая таблица заказов из Arrow-кеша, а при промахе - подготовка с нуля и запись в кеш.
+
+    Ключ кеша зависит от содержимого архива, файлов с границами (source_paths) и версии кода,
+    поэтому после любого их изменения таблица пересчитается сама.
+    """
+    key = orders_key(data_url, source_paths, frac, seed, distance_method)
+    path = artifact_path('orders', key, 'arrow')
+    if os.path.exists(path):
+        return read_table(path)
+    df = prepare_orders(data_url, districts, frac, seed, chunksize, distance_method, workers)
+    write_table(df, path)
+    return read_table(path)
+
+
+def build_artifacts(data_url, source_paths, out_dir, frac, seed, chunksize, distance_method='ellipsoidal',
+                    hex_radius=120, workers=1):
+    """Считает все, что нужно странице, и складывает в out_dir/<версия>/.
+
+    Внутри: orders.arrow - обогащенная таблица в порядке OrderStore, cube.arrow - ячейки куба,
+    daily.arrow - разрезы куба по дням заказов для фильтра по периоду,
+    hexbins.arrow - шестиугольники по (день недели, время дня), clusters.arrow - пирамида кластеров (только самый
+    подробный уровень), daily_hexbins.arrow и daily_clusters.arrow - то же по дням заказов на грубой сетке,
+    districts.geojson - иерархия районов, boundaries.json - готовые GeoJSON-строки для картограммы,
+    manifest.json - описание версии (mode='sample'). Файл LATEST в out_dir указывает на последнюю собранную версию.
+    """
+    districts = load_district_hierarchy(*source_paths)
+    key = orders_key(data_url, source_paths, frac, seed, distance_method, hex_radius,
+                     modules=PIPELINE_MODULES)
+    target = os.path.join(out_dir, key)
+    os.makedirs(target, exist_ok=True)
+
+    order_store = OrderStore(prepare_orders(data_url, districts, frac, seed, chunksize, distance_method, workers))
+    aggregates = Aggregates(hex_radius)
+    aggregates.add(order_store)
+    _write_artifacts(target, order_store.orders, aggregates, districts, source_paths)
+    _write_json(os.path.join(target, 'manifest.json'),
+                {'version': key, 'format': ARTIFACTS_FORMAT, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                 'mode': 'sample', 'rows': len(order_store.orders),
+                 'params': {'data_url': data_url, 'frac': frac, 'seed': seed, 'distance_method': distance_method,
+                            'hex_radius': hex_radius}})
+    atomic_write(os.path.join(out_dir, 'LATEST'), lambda tmp: _write_text(tmp, key))
+    return target
+
+
+def build_full_artifacts(data_url, source_paths, out_dir, memory_budget, frac=None, seed=None,
+                         distance_method='ellipsoidal', hex_radius=120, workers=1, preview_rows=50_000):
+    """То же, что build_artifacts, но по всему архиву и без загрузки его в память целиком.
+
+    Архив идет кусками, размер которых подбирается под memory_budget байт. Каждый кусок обогащается
+    и сразу сворачивается в частичные агрегаты (Aggregates), которые складываются с уже накопленными.
+    От строк остается только равномерная выборка preview_rows заказов для таблицы на странице.
+    Накопленное между кусками тоже входит в бюджет: кусок берется из того, что осталось.
+    frac включает выборку явно - по умолчанию берутся все заказы.
+    """
+    districts = load_district_hierarchy(*source_paths)
+    key = orders_key(data_url, source_paths, 'full', frac, seed, distance_method, hex_radius, preview_rows,
+                     modules=PIPELINE_MODULES)
+    target = os.path.join(out_dir, key)
+    os.makedirs(target, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    preview = Reservoir(preview_rows, rng)
+    aggregates, rows = Aggregates(hex_radius), 0
+
+    def reserved():
+        preview_bytes = preview.rows.memory_usage(deep=True).sum() if preview.rows is not None else 0
+        return aggregates.memory_usage() + preview_bytes
+
+    for chunk in iter_budgeted_chunks(data_url, memory_budget, reserved=reserved):
+        if frac is not None:
+            chunk = chunk[rng.random(len(chunk)) < frac]
+        part = OrderStore(enrich_chunk(chunk, districts, distance_method, workers))
+        rows += len(part.orders)
+        preview.add(part.orders)
+        aggregates.add(part)
+
+    if not rows:
+        raise ValueError(f'В архиве {data_url} нет заказов')
+    # Куски с разными наборами категорий склеиваются в object, OrderStore переводит их обратно
+    preview_store = OrderStore(preview.rows)
+    _write_artifacts(target, preview_store.orders, aggregates, districts, source_paths)
+    _write_json(os.path.join(target, 'manifest.json'),
+                {'version': key, 'format': ARTIFACTS_FORMAT, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                 'mode': 'full',
+                 'rows': rows, 'preview_rows': len(preview_store.orders),
+                 'params': {'data_url': data_url, 'frac': frac, 'seed': seed, 'distance_method': distance_method,
+                            'hex_radius': hex_radius, 'memory_budget': memory_budget}})
+    atomic_write(os.path.join(out_dir, 'LATEST'), lambda tmp: _write_text(tmp, key))
+    return target
+
+
+class Aggregates:
+    """Все, что страница берет вместо сырых заказов: куб, его разрезы по дням, шестиугольники и кластеры
+    (подробные за весь период и грубые по дням). add досчитывает их по очередному куску заказов."""
+
+    def __init__(self, hex_radius):
+        self.hex_radius = hex_radius
+        self.cube = self.daily_cube = self.pyramid = self.daily_pyramid = None
+        self.hexbins, self.daily_hexbins = {}, {}
+
+    def add(self, order_store):
+        orders = order_store.orders
+        self.cube = OrderCube.from_orders(orders) if self.cube is None else self.cube.append(orders)
+        self.daily_cube = DailyCube.from_orders(orders) if self.daily_cube is None else self.daily_cube.append(orders)
+        for hexbins, daily in ((self.hexbins, False), (self.daily_hexbins, True)):
+            radius = self.hex_radius * DAILY_HEX_SCALE if daily else self.hex_radius
+            for slice_key, cells in slice_hexbins(order_store, self.hex_radius, daily).items():
+                if slice_key in hexbins:
+                    cells = merge_hexbins([hexbins[slice_key], cells], radius=radius)
+                hexbins[slice_key] = cells
+        pyramid, daily_pyramid = order_pyramid(orders), order_pyramid(orders, daily=True)
+        self.pyramid = pyramid if self.pyramid is None else self.pyramid.merge(pyramid)
+        self.daily_pyramid = daily_pyramid if self.daily_pyramid is None else self.daily_pyramid.merge(daily_pyramid)
+        return self
+
+    def memory_usage(self):
+        """Сколько байт занимают накопленные таблицы."""
+        if self.cube is None:
+            return 0
+        frames = [self.cube.cells, self.pyramid.cells, self.daily_pyramid.cells,
+                  *(view.cells for view in self.daily_cube.views),
+                  *self.hexbins.values(), *self.daily_hexbins.values()]
+        return int(sum(frame.memory_usage(deep=True).sum() for frame in frames))
+
+
+def slice_hexbins(order_store, radius, daily=False):
+    """Шестиугольники для каждого куска (день недели, время дня). С daily - по дням заказов
+    и на сетке в DAILY_HEX_SCALE раз крупнее radius."""
+    if daily:
+        radius *= DAILY_HEX_SCALE
+    return {key: hexbin(part['location_latitude'], part['location_longitude'], radius=radius,
+                        days=part[DAY_COLUMN] if daily else None)
+            for key, part in order_store.partitions()}
+
+
+def hexbin_table(hexbins):
+    """Шестиугольники всех кусков одной таблицей с колонками day_of_week и Times_of_Day.
+    Центры ячеек в нее не входят: страница считает их по q и r только для выбранного периода."""
+    cells = [part.drop(columns=['location_latitude', 'location_longitude'])
+                 .assign(day_of_week=day, Times_of_Day=time_of_day)
+             for (day, time_of_day), part in hexbins.items()]
+    return pd.concat(cells, ignore_index=True) if cells else pd.DataFrame()
+
+
+def order_pyramid(orders, daily=False):
+    """Пирамида кластеров; с daily - по дням заказов и только до зума DAILY_MAX_ZOOM."""
+    if daily:
+        return ClusterPyramid.from_points(orders['location_latitude'], orders['location_longitude'],
+                                          max_zoom=DAILY_MAX_ZOOM, days=orders[DAY_COLUMN])
+    return ClusterPyramid.from_points(orders['location_latitude'], orders['location_longitude'])
+
+
+def _write_artifacts(target, orders, aggregates, districts, source_paths):
+    write_table(orders, os.path.join(target, 'orders.arrow'))
+    write_table(aggregates.cube.to_frame(), os.path.join(target, 'cube.arrow'))
+    write_table(aggregates.daily_cube.to_frame(), os.path.join(target, 'daily.arrow'))
+    write_table(hexbin_table(aggregates.hexbins), os.path.join(target, 'hexbins.arrow'))
+    write_table(hexbin_table(aggregates.daily_hexbins), os.path.join(target, 'daily_hexbins.arrow'))
+    write_table(aggregates.pyramid.to_frame(), os.path.join(target, 'clusters.arrow'))
+    write_table(aggregates.daily_pyramid.to_frame(), os.path.join(target, 'daily_clusters.arrow'))
+
+    atomic_write(os.path.join(target, 'districts.geojson'), lambda tmp: districts.to_file(tmp, driver='GeoJSON'))
+    okruga = geopandas.read_file(source_paths[2])
+    okruga = okruga[okruga['local_name'].isin(districts['okrug'])][['local_name', 'geometry']]
+    boundaries = {'Округа': geojson_layers(okruga),
+                  'Районы': geojson_layers(districts[['district', 'okrug', 'geometry']])}
+    _write_json(os.path.join(target, 'boundaries.json'), boundaries)
+
+
+def latest_version(out_dir):
+    """Ключ последней собранной версии артефактов из out_dir/LATEST или None."""
+    try:
+        with open(os.path.join(out_dir, 'LATEST'), encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+class Artifacts:
+    """Собранная версия артефактов. Таблицы читаются через memory map при первом обращении."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+
+    @classmethod
+    def latest(cls, out_dir):
+        """Последняя собранная версия или None, если пайплайн еще ни разу не запускался."""
+        version = latest_version(out_dir)
+        if not version:
+            return None
+        latest = cls(os.path.join(out_dir, version))
+        return latest if latest.manifest.get('format') == ARTIFACTS_FORMAT else None
+
+    def orders(self):
+        return read_table(os.path.join(self.path, 'orders.arrow'))
+
+    def cube(self):
+        return OrderCube.from_frame(read_table(os.path.join(self.path, 'cube.arrow')))
+
+    def daily_cube(self):
+        return DailyCube.from_frame(read_table(os.path.join(self.path, 'daily.arrow')))
+
+    def hexbins(self):
+        """Таблица шестиугольников, как ее строит hexbin_table."""
+        return read_table(os.path.join(self.path, 'hexbins.arrow'))
+
+    def daily_hexbins(self):
+        return read_table(os.path.join(self.path, 'daily_hexbins.arrow'))
+
+    def cluster_pyramid(self):
+        return ClusterPyramid.from_frame(read_table(os.path.join(self.path, 'clusters.arrow')))
+
+    def daily_pyramid(self):
+        return ClusterPyramid.from_frame(read_table(os.path.join(self.path, 'daily_clusters.arrow')))
+
+    def districts(self):
+        return geopandas.read_file(os.path.join(self.path, 'districts.geojson'))
+
+    def boundary_layers(self):
+        with open(os.path.join(self.path, 'boundaries.json'), encoding='utf-8') as f:
+            return json.load(f)
+
+
+def _write_text(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _write_json(path, value):
+    atomic_write(path, lambda tmp: _write_text(tmp, json.dumps(value, ensure_ascii=False)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-подготовка артефактов для страницы с заказами')
+    parser.add_argument('--data-url', default=settings.DATA_URL)
+    parser.add_argument('--output', default=settings.ARTIFACTS_DIR)
+    parser.add_argument('--sample-frac', type=float, default=None,
+                        help=f'доля заказов; по умолчанию {settings.SAMPLE_FRAC}, а с --full - все заказы')
+    parser.add_argument('--seed', type=int, default=settings.SAMPLE_SEED)
+    parser.add_argument('--chunksize', type=int, default=settings.CHUNKSIZE)
+    parser.add_argument('--distance-method', choices=['ellipsoidal', 'spherical'],
+                        default=settings.DISTANCE_METHOD)
+    parser.add_argument('--workers', type=int, default=settings.ENRICH_WORKERS,
+                        help='процессов для поиска районов и расстояний, 1 - последовательно')
+    parser.add_argument('--full', action='store_true',
+                        help='считать агрегаты по всему архиву кусками, не загружая его в память целиком')
+    parser.add_argument('--memory-budget-mb', type=int, default=settings.MEMORY_BUDGET_MB,
+                        help='сколько памяти может занимать обрабатываемый кусок в режиме --full')
+    parser.add_argument('--preview-rows', type=int, default=settings.PREVIEW_ROWS,
+                        help='сколько заказов сохранить для таблицы на странице в режиме --full')
+    args = parser.parse_args()
+    if args.full:
+        target = build_full_artifacts(args.data_url, settings.DISTRICT_SOURCES, args.output,
+                                      args.memory_budget_mb << 20, args.sample_frac, args.seed,
+                                      args.distance_method, settings.HEX_RADIUS, args.workers, args.preview_rows)
+    else:
+        frac = settings.SAMPLE_FRAC if args.sample_frac is None else args.sample_frac
+        target = build_artifacts(args.data_url, settings.DISTRICT_SOURCES, args.output, frac, args.seed,
+                                 args.chunksize, args.distance_method, settings.HEX_RADIUS, args.workers)
+    print(target)
+
+
+if __name__ == '__main__':
+    main()
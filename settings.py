@@ -0,0 +1,29 @@
+import os
+
+# Все настройки можно переопределить через переменные окружения пода
+
+# Архив с заказами
+DATA_URL = os.environ.get('ORDERS_DATA_URL', 'yangodatanorm 3.csv.zip')
+# Границы: районы, контур Москвы, округа
+DISTRICT_SOURCES = ('zip://districts.geojson.zip', 'moscow.geojson', 'okruga.geojson')
+# 'ellipsoidal' - геодезическая на WGS84 как в geopy, 'spherical' - гаверсинусы
+DISTANCE_METHOD = os.environ.get('ORDERS_DISTANCE_METHOD', 'ellipsoidal')
+# Радиус шестиугольника на карте pydeck, метры
+HEX_RADIUS = 120
+# Сколько процессов ищут районы и расстояния; 1 - последовательно, результат одинаковый
+ENRICH_WORKERS = int(os.environ.get('ORDERS_ENRICH_WORKERS', 1))
+# Какую долю заказов берем в анализ и с каким зерном - одно и то же зерно дает ту же выборку
+SAMPLE_FRAC = float(os.environ.get('ORDERS_SAMPLE_FRAC', 0.01))
+SAMPLE_SEED = int(os.environ.get('ORDERS_SAMPLE_SEED', 42))
+# Сколько строк CSV разбираем за один раз
+CHUNKSIZE = int(os.environ.get('ORDERS_CHUNKSIZE', 200_000))
+# Замеры времени и памяти по этапам с панелью в сайдбаре (ORDERS_PROFILE=1)
+PROFILE_STAGES = os.environ.get('ORDERS_PROFILE', '0') == '1'
+# Если задан, замеры каждого прогона дописываются в этот файл в формате JSON lines
+PROFILE_LOG = os.environ.get('ORDERS_PROFILE_LOG')
+# Куда офлайн-пайплайн (python pipeline.py) складывает артефакты и откуда их берет страница
+ARTIFACTS_DIR = os.environ.get('ORDERS_ARTIFACTS_DIR', 'artifacts')
+# Режим pipeline.py --full: сколько памяти может занимать обрабатываемый кусок архива, мегабайты,
+# и сколько заказов из всего архива сохраняется для таблицы на странице
+MEMORY_BUDGET_MB = int(os.environ.get('ORDERS_MEMORY_BUDGET_MB', 512))
+PREVIEW_ROWS = int(os.environ.get('ORDERS_PREVIEW_ROWS', 50_000))
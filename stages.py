@@ -0,0 +1,237 @@
+import functools
+import hashlib
+import inspect
+import os
+import sys
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from instrumentation import collect, stage as measure
+
+
+@functools.lru_cache(maxsize=None)
+def _source_hash(path, mtime_ns):
+    with open(path, 'rb') as source:
+        return hashlib.sha256(source.read()).hexdigest()
+
+
+def _project_modules(value, home, found):
+    """Модули проекта (файлы из каталога home), код которых может выполнить value, со всеми их импортами."""
+    module = value if inspect.ismodule(value) else sys.modules.get(getattr(value, '__module__', None) or '')
+    path = getattr(module, '__file__', None)
+    if not path or module.__name__ in found or os.path.dirname(os.path.abspath(path)) != home:
+        return found
+    found[module.__name__] = path
+    for member in list(vars(module).values()):
+        if inspect.ismodule(member) or inspect.isfunction(member) or inspect.isclass(member):
+            _project_modules(member, home, found)
+    return found
+
+
+def code_version(fn):
+    """Версия функции этапа по ее байткоду и константам, включая вложенные функции.
+    Номера строк и имя файла в нее не входят, так что правка соседнего кода ключ не меняет.
+
+    В версию входит и то, что функция берет из глобальных имен: константы (имена в верхнем регистре) -
+    по значению, функции того же файла - по их коду, а модули проекта, из которых она что-то вызывает, -
+    по исходникам вместе со всем, что они импортируют. Так правка charts.py или HEX_RADIUS меняет ключ.
+    """
+    digest = hashlib.sha256()
+    home = os.path.dirname(os.path.abspath(fn.__code__.co_filename))
+    names, modules = set(), {}
+
+    def update(code):
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                update(const)
+            else:
+                digest.update(repr(const).encode())
+        for name in code.co_names:
+            if name in names or name not in fn.__globals__:
+                continue
+            names.add(name)
+            value = fn.__globals__[name]
+            if name.isupper():
+                digest.update(f'{name}={value!r}'.encode())
+            elif inspect.isfunction(value) and value.__globals__ is fn.__globals__:
+                update(value.__code__)
+            else:
+                _project_modules(value, home, modules)
+
+    update(fn.__code__)
+    for name, path in sorted(modules.items()):
+        digest.update(f'{name}:{_source_hash(path, os.stat(path).st_mtime_ns)}'.encode())
+    return digest.hexdigest()[:16]
+
+
+class Stage:
+    def __init__(self, name, fn, inputs, params, fingerprint, keep):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.params = tuple(params)
+        self.fingerprint = fingerprint
+        self.keep = keep
+        self.version = code_version(fn)
+
+
+class StageGraph:
+    """Этапы страницы, у каждого из которых явно перечислены входы.
+
+    inputs - имена этапов, результаты которых функция получает позиционными аргументами,
+    params - имена параметров (обычно значений виджетов), которые она получает по имени.
+    Результат хранится под ключом из версии кода этапа, ключей его входов и значений его параметров,
+    как в дереве Меркла. Поэтому изменение виджета меняет ключи только у этапов ниже по графу,
+    а все, что выше, берется из кеша. У источников (этапов без входов) ключ дополняется отпечатком
+    fingerprint() - например, версией собранных артефактов, - так что новые данные пересчитывают весь граф.
+
+    Граф один на процесс и общий для всех сессий; keep - сколько последних результатов этапа хранить.
+    Тяжелые этапы можно запускать в фоне через submit, чтобы страница рисовалась по мере готовности данных.
+    """
+
+    def __init__(self, workers=4):
+        self.stages = {}
+        self.results = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.workers = workers
+        self.executor = None
+        self.futures = {}
+        # Ошибки фоновых расчетов по ключу: упавший этап не запускается заново, пока ключ тот же
+        self.errors = {}
+        # Сколько вычислений каждого этапа идет прямо сейчас - для индикатора прогресса
+        self.active = Counter()
+
+    def stage(self, inputs=(), params=(), fingerprint=None, keep=None, name=None):
+        """Декоратор, регистрирующий функцию как этап. Повторная регистрация (при новом прогоне скрипта)
+        просто заменяет функцию; если код не поменялся, ключи и кеш остаются прежними."""
+
+        def decorator(fn):
+            stage_name = name or fn.__name__
+            # Этапы с параметрами хранят несколько последних вариантов, остальные - только актуальный
+            stage_keep = keep if keep is not None else (16 if params else 1)
+            with self.lock:
+                self.stages[stage_name] = Stage(stage_name, fn, inputs, params, fingerprint, stage_keep)
+                self.results.setdefault(stage_name, OrderedDict())
+            return fn
+
+        return decorator
+
+    def key(self, name, params):
+        stage = self.stages[name]
+        parts = [name, stage.version]
+        if stage.fingerprint is not None:
+            parts.append(stage.fingerprint())
+        parts.extend(self.key(upstream, params) for upstream in stage.inputs)
+        parts.extend((param, params[param]) for param in stage.params)
+        return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+    def get(self, name, **params):
+        """Результат этапа name; недостающие этапы выше по графу считаются по пути.
+        params - значения всех виджетов, каждый этап берет из них только свои."""
+        stage = self.stages[name]
+        key = self.key(name, params)
+        with measure(name) as record:
+            results = self.results[name]
+            with self.lock:
+                key_lock = self.key_locks.setdefault((name, key), threading.Lock())
+            # Две сессии, попросившие один и тот же ключ, считают его один раз
+            with key_lock:
+                with self.lock:
+                    hit = key in results
+                    if hit:
+                        results.move_to_end(key)
+                        value = results[key]
+                if not hit:
+                    args = [self.get(upstream, **params) for upstream in stage.inputs]
+                    with self.lock:
+                        self.active[name] += 1
+                    try:
+                        value = stage.fn(*args, **{param: params[param] for param in stage.params})
+                    finally:
+                        with self.lock:
+                            self.active[name] -= 1
+                    with self.lock:
+                        results[key] = value
+                        while len(results) > stage.keep:
+                            stale, _ = results.popitem(last=False)
+                            self.key_locks.pop((name, stale), None)
+            record['cache'] = 'hit' if hit else 'miss'
+            try:
+                record['rows_out'] = len(value)
+            except TypeError:
+                pass
+        return value
+
+    def submit(self, name, **params):
+        """Future с результатом этапа, который считается в фоновом потоке.
+
+        Все сессии, запросившие один и тот же ключ, пока он считается, получают один и тот же Future,
+        так что холодный старт не запускает подготовку по разу на каждого посетителя.
+        Готовый результат отдается сразу завершенным Future. В future.records - замеры расчета.
+        Если расчет с этим ключом уже упал, Future сразу завершен той же ошибкой: новый ключ (после правки
+        кода или данных) или clear() запускают расчет заново.
+        """
+        key = self.key(name, params)
+        with self.lock:
+            if key in self.results[name]:
+                future = Future()
+                future.records = []
+                future.set_result(self.results[name][key])
+                return future
+            if (name, key) in self.errors:
+                future = Future()
+                future.records = []
+                future.set_exception(self.errors[(name, key)])
+                return future
+            if (name, key) in self.futures:
+                return self.futures[(name, key)]
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='stages')
+            # Замеры фонового расчета едут вместе с Future: у потока пула нет своего прогона страницы
+            records = []
+            future = self.executor.submit(self._run, name, params, records)
+            future.records = records
+            self.futures[(name, key)] = future
+        future.add_done_callback(lambda done: self._forget(name, key, done))
+        return future
+
+    def _run(self, name, params, records):
+        with collect(records):
+            return self.get(name, **params)
+
+    def _forget(self, name, key, future):
+        with self.lock:
+            self.futures.pop((name, key), None)
+            if not future.cancelled() and future.exception() is not None:
+                self.errors[(name, key)] = future.exception()
+
+    def progress(self, names, **params):
+        """Доля уже посчитанных этапов среди names и всех этапов выше них по графу."""
+        keys = {}
+
+        def visit(name):
+            if name not in keys:
+                keys[name] = self.key(name, params)
+                for upstream in self.stages[name].inputs:
+                    visit(upstream)
+
+        for name in names:
+            visit(name)
+        with self.lock:
+            done = sum(key in self.results[name] for name, key in keys.items())
+        return done / len(keys) if keys else 1.0
+
+    def running(self):
+        """Этапы, которые считаются прямо сейчас."""
+        with self.lock:
+            return sorted(name for name, count in self.active.items() if count > 0)
+
+    def clear(self):
+        with self.lock:
+            for results in self.results.values():
+                results.clear()
+            self.errors.clear()
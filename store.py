@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+from enrichment import TIMES_OF_DAY, WEEKDAYS, with_columns
+from timeindex import from_day
+
+# Колонки-измерения храним как категории: код в int8/int16 вместо python-строки в каждой строке
+CATEGORICAL_COLUMNS = ['district', 'okrug', 'os', 'device', 'app_version', 'user_agent']
+
+
+class OrderStore:
+    """Заказы, физически разложенные по (день недели, время дня).
+
+    Строки отсортированы по коду дня и коду времени, а границы всех 28 кусков посчитаны заранее,
+    поэтому любой кусок - это срез iloc[start:stop] без просмотра таблицы.
+    """
+
+    def __init__(self, orders):
+        orders = with_columns(
+            orders,
+            day_of_week=pd.Categorical(orders['day_of_week'], categories=WEEKDAYS, ordered=True),
+            Times_of_Day=pd.Categorical(orders['Times_of_Day'], categories=TIMES_OF_DAY, ordered=True),
+            **{column: orders[column].astype('category') for column in CATEGORICAL_COLUMNS if column in orders})
+        keys = self._keys(orders['day_of_week'].cat.codes.to_numpy(), orders['Times_of_Day'].cat.codes.to_numpy())
+        if (np.diff(keys) < 0).any():
+            order = np.argsort(keys, kind='stable')
+            orders = orders.iloc[order]
+            keys = keys[order]
+        if not orders.index.equals(pd.RangeIndex(len(orders))):
+            # Новый индекс без копии данных
+            orders = orders.copy(deep=False)
+            orders.index = pd.RangeIndex(len(orders))
+        self.orders = orders
+        # offsets[k]:offsets[k + 1] - строки куска с ключом k
+        self.offsets = np.searchsorted(keys, np.arange(len(WEEKDAYS) * len(TIMES_OF_DAY) + 1))
+        self._by_time = None
+
+    @staticmethod
+    def _keys(day_codes, time_codes):
+        return day_codes.astype('int64') * len(TIMES_OF_DAY) + time_codes
+
+    def _bounds(self, day, time_of_day=None):
+        d = WEEKDAYS.index(day)
+        if time_of_day is None:
+            return self.offsets[d * len(TIMES_OF_DAY)], self.offsets[(d + 1) * len(TIMES_OF_DAY)]
+        k = d * len(TIMES_OF_DAY) + TIMES_OF_DAY.index(time_of_day)
+        return self.offsets[k], self.offsets[k + 1]
+
+    def slice(self, day, time_of_day=None):
+        """Заказы одного дня недели (и, если задано, одного времени дня)."""
+        start, stop = self._bounds(day, time_of_day)
+        return self.orders.iloc[start:stop]
+
+    def between(self, start, end):
+        """Заказы с днем (UTC) в [start, end] в порядке хранения.
+
+        Индекс по времени - перестановка строк по created_at и отсортированные значения; он строится
+        при первом запросе, а дальше интервал находится двумя бинарными поисками.
+        """
+        if self._by_time is None:
+            created_at = self.orders['created_at'].dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+            order = np.argsort(created_at, kind='stable')
+            self._by_time = order, created_at[order]
+        order, times = self._by_time
+        bounds = np.array([from_day(start), from_day(end + 1)], dtype='datetime64[D]').astype(times.dtype)
+        lo, hi = np.searchsorted(times, bounds, side='left')
+        return self.orders.iloc[np.sort(order[lo:hi])]
+
+    def partitions(self):
+        """Все непустые куски по порядку: ((день недели, время дня), заказы)."""
+        for day in WEEKDAYS:
+            for time_of_day in TIMES_OF_DAY:
+                start, stop = self._bounds(day, time_of_day)
+                if stop > start:
+                    yield (day, time_of_day), self.orders.iloc[start:stop]
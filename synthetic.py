@@ -0,0 +1,65 @@
+import geopandas
+import numpy as np
+import pandas as pd
+
+from enrichment import MOSCOW_CENTER
+
+# Доля заказов по часам суток (UTC, как в created_at): пики в обед и вечером по Москве
+HOUR_WEIGHTS = np.array([6, 4, 2, 1, 1, 1, 2, 4, 6, 9, 12, 11, 9, 8, 9, 11, 14, 16, 15, 12, 10, 9, 8, 7], dtype='float64')
+USER_AGENTS = [
+    ('Mozilla/5.0 (iPhone; CPU iPhone OS 15_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148', 0.34),
+    ('Mozilla/5.0 (Linux; Android 11; SM-A515F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0 Mobile Safari/537.36', 0.30),
+    ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0 Safari/537.36', 0.14),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.4 Safari/605.1.15', 0.08),
+    ('YandexEda/3.41.0 (iOS 15.4; iPhone13,2)', 0.07),
+    ('YandexEda/3.40.1 (Android 12; Pixel 6)', 0.05),
+    ('Mozilla/5.0 (X11; Linux x86_64; rv:99.0) Gecko/20100101 Firefox/99.0', 0.02),
+]
+
+
+def points_inside(outline, n, rng, spread_km=9.0):
+    """n точек внутри контура: нормальное облако вокруг центра, как у настоящих заказов, с отбраковкой
+    всего, что не попало в контур. Проверка попадания - через пространственный индекс, пачками."""
+    c_lat, c_lon = MOSCOW_CENTER
+    lat_sd = spread_km / 111.32
+    lon_sd = spread_km / (111.32 * np.cos(np.radians(c_lat)))
+    polygons = geopandas.GeoDataFrame(geometry=[outline])
+    lats, lons, have = [], [], 0
+    while have < n:
+        batch = max(int((n - have) * 1.3), 1000)
+        lat = rng.normal(c_lat, lat_sd, batch)
+        lon = rng.normal(c_lon, lon_sd, batch)
+        points = geopandas.GeoDataFrame(geometry=geopandas.points_from_xy(lon, lat))
+        inside = np.unique(geopandas.sjoin(points, polygons, how='inner', predicate='within').index.to_numpy())
+        lats.append(lat[inside])
+        lons.append(lon[inside])
+        have += len(inside)
+    return np.concatenate(lats)[:n], np.concatenate(lons)[:n]
+
+
+def generate_orders(n, seed=0, outline_path='moscow.geojson', start='2022-01-01', days=60):
+    """Синтетические заказы в формате архива: те же колонки, правдоподобные распределения.
+
+    Координаты лежат внутри контура Москвы, время заказа следует суточному профилю HOUR_WEIGHTS,
+    чек - логнормальный (медиана около 900 рублей), user_agent выбирается из USER_AGENTS с их весами.
+    """
+    rng = np.random.default_rng(seed)
+    outline = geopandas.read_file(outline_path).geometry.iloc[0]
+    lat, lon = points_inside(outline, n, rng)
+    day = rng.integers(0, days, n)
+    hour = rng.choice(24, n, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    seconds = day * 86400 + hour * 3600 + rng.integers(0, 3600, n)
+    created_at = pd.Timestamp(start, tz='UTC') + pd.to_timedelta(seconds, unit='s')
+    agents, weights = zip(*USER_AGENTS)
+    weights = np.array(weights) / np.sum(weights)
+    return pd.DataFrame({'id': np.arange(1, n + 1, dtype='int64'),
+                         'created_at': created_at.astype(str),
+                         'amount_charged': np.round(rng.lognormal(np.log(900), 0.55, n), 2),
+                         'user_agent': np.asarray(agents, dtype=object)[rng.choice(len(agents), n, p=weights)],
+                         'location_latitude': lat,
+                         'location_longitude': lon})
+
+
+def write_archive(orders, path):
+    """Пишет заказы zip-архивом CSV, как настоящий дамп, чтобы на нем можно было мерить и чтение."""
+    orders.to_csv(path, compression={'method': 'zip', 'archive_name': 'orders.csv'})
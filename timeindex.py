@@ -0,0 +1,61 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+# День заказа храним числом: дни от 1970-01-01 по UTC, как и время дня в created_at
+DAY_COLUMN = 'order_day'
+EPOCH = pd.Timestamp(0, tz='UTC')
+
+
+def order_days(created_at):
+    """Номер дня (UTC) каждого заказа; -1 - время заказа неизвестно."""
+    return ((created_at - EPOCH) // pd.Timedelta(days=1)).fillna(-1).astype('int32')
+
+
+def to_day(date):
+    return (datetime.date.fromisoformat(str(date)[:10]) - datetime.date(1970, 1, 1)).days
+
+
+def from_day(day):
+    return datetime.date(1970, 1, 1) + datetime.timedelta(days=int(day))
+
+
+class PrefixSums:
+    """Суммы measures по ячейкам keys за любой интервал дней.
+
+    Строки сортируются по (ячейка, день), и по ним считаются накопленные суммы. Тогда сумма ячейки
+    за [start, end] - разность двух накопленных сумм, а их позиции находятся бинарным поиском
+    по составному ключу ячейка * span + день: O(log n) на ячейку, без просмотра строк.
+    Строки без дня (-1) не попадают ни в один интервал.
+    """
+
+    def __init__(self, frame, keys, measures, day=DAY_COLUMN):
+        frame = frame[frame[day].to_numpy() >= 0]
+        self.keys = list(keys)
+        self.measures = list(measures)
+        days = frame[day].to_numpy().astype('int64')
+        cells = frame.groupby(self.keys, observed=True, sort=False, dropna=False).ngroup().to_numpy()
+        order = np.lexsort((days, cells))
+        days, cells = days[order], cells[order]
+        self.first_day = int(days.min()) if len(days) else 0
+        self.last_day = int(days.max()) if len(days) else -1
+        self.span = self.last_day - self.first_day + 1
+        self.positions = cells * self.span + (days - self.first_day)
+        starts = np.flatnonzero(np.r_[True, np.diff(cells) != 0]) if len(cells) else np.empty(0, dtype='int64')
+        self.cells = frame[self.keys].iloc[order[starts]].reset_index(drop=True)
+        self.prefix = {measure: np.concatenate([np.zeros(1, dtype=values.dtype), np.cumsum(values)])
+                       for measure in self.measures
+                       for values in [frame[measure].to_numpy()[order]]}
+
+    def between(self, start, end):
+        """Ячейки с их суммами за дни [start, end]; пустые за этот интервал ячейки не возвращаются."""
+        start, end = max(int(start), self.first_day), min(int(end), self.last_day)
+        if start > end:
+            return self.cells.iloc[:0].assign(**{measure: self.prefix[measure][:0] for measure in self.measures})
+        base = np.arange(len(self.cells), dtype='int64') * self.span
+        lo = np.searchsorted(self.positions, base + (start - self.first_day), side='left')
+        hi = np.searchsorted(self.positions, base + (end - self.first_day), side='right')
+        nonempty = hi > lo
+        return self.cells[nonempty].reset_index(drop=True).assign(
+            **{measure: (prefix[hi] - prefix[lo])[nonempty] for measure, prefix in self.prefix.items()})
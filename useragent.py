@@ -0,0 +1,63 @@
+import re
+from functools import lru_cache
+
+import pandas as pd
+
+from enrichment import with_columns
+
+# Таблица правил: (поле, регулярка по user_agent в нижнем регистре, значение).
+# Для каждого поля срабатывает первое подходящее правило сверху, поэтому более сильные признаки идут раньше.
+# Значение None означает "взять первую группу регулярки". Новые правила просто дописываются в таблицу.
+UA_RULES = [
+    ('os', r'android', 'Android'),
+    ('os', r'windows', 'Windows'),
+    ('os', r'macintosh', 'Mac OS X'),
+    ('os', r'iphone', 'IOS'),
+    ('os', r'ios', 'IOS'),
+    ('device', r'ipad|tablet', 'tablet'),
+    ('device', r'mobi|iphone|android', 'mobile'),
+    ('app_version', r'(?:yandex\s*eda|yandexeda|eda)[/ ]v?(\d+(?:\.\d+)+)', None),
+]
+UA_DEFAULTS = {'os': 'Other', 'device': 'desktop', 'app_version': 'unknown'}
+UA_FIELDS = list(UA_DEFAULTS)
+
+_COMPILED_RULES = [(field, re.compile(pattern), value) for field, pattern, value in UA_RULES]
+
+
+@lru_cache(maxsize=100_000)
+def classify_user_agent(user_agent):
+    """(os, device, app_version) для одной строки user_agent. Память между перезапусками скрипта - lru_cache."""
+    user_agent = user_agent.lower()
+    result = dict(UA_DEFAULTS)
+    matched = set()
+    for field, pattern, value in _COMPILED_RULES:
+        if field in matched:
+            continue
+        match = pattern.search(user_agent)
+        if match:
+            result[field] = value if value is not None else match.group(1)
+            matched.add(field)
+    return tuple(result[field] for field in UA_FIELDS)
+
+
+def classify_user_agents(user_agents):
+    """Разбирает колонку user_agent: правила применяются только к уникальным строкам,
+    а результат раскладывается обратно по строкам через коды категорий."""
+    codes, uniques = pd.factorize(user_agents)
+    classified = [classify_user_agent(ua) for ua in uniques]
+    columns = {}
+    for i, field in enumerate(UA_FIELDS):
+        values = [labels[i] for labels in classified] + [UA_DEFAULTS[field]]
+        value_codes, categories = pd.factorize(pd.Series(values, dtype='object'))
+        # Код -1 у пропущенного user_agent попадает на последний элемент - значение по умолчанию
+        columns[field] = pd.Categorical.from_codes(value_codes[codes], categories=categories)
+    return pd.DataFrame(columns, index=user_agents.index)
+
+
+def add_user_agent_features(df):
+    """ОС, устройство и версия приложения; сам user_agent тоже становится категорией -
+    различных строк в нем на порядки меньше, чем заказов."""
+    user_agent = df['user_agent']
+    if not isinstance(user_agent.dtype, pd.CategoricalDtype):
+        user_agent = user_agent.astype('category')
+    return with_columns(df, user_agent=user_agent, **classify_user_agents(user_agent))